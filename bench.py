@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import uuid
+import zlib
+import signal
+import random
+import asyncio
+import secrets
+import datetime
+import statistics
+import subprocess
+import multiprocessing
+from typing import Awaitable, Callable
+
+import requests
+import fastapi.encoders
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+import models
+import memory
+import storage
+import database
+import services
+import compressor
+
+
+# бенчмарк гоняет сервисы в том же процессе, без HTTP. Хранилище в памяти
+# проверяется всегда, PostgreSQL только если задан DATABASE_URI (схема
+# из migration.sql должна быть применена, данные после прогона остаются)
+DATABASE_URI = os.getenv('DATABASE_URI')
+BENCH_TASKS = int(os.getenv('BENCH_TASKS', '10000'))
+BENCH_ROUNDS = int(os.getenv('BENCH_ROUNDS', '200'))
+# масштабирование по процессам: src/serve.py с каждым значением WORKERS
+# из списка (например 1,2,4) против PostgreSQL, нагрузку дают BENCH_CLIENTS
+# процессов, которые BENCH_DURATION секунд запрашивают листинг
+BENCH_WORKERS = os.getenv('BENCH_WORKERS')
+BENCH_CLIENTS = int(os.getenv('BENCH_CLIENTS', '8'))
+BENCH_DURATION = float(os.getenv('BENCH_DURATION', '5'))
+BENCH_PORT = int(os.getenv('BENCH_PORT', '8100'))
+# сжатие листинга из BENCH_TASKS задач: время на сжатие и распаковку против
+# выигрыша в передаче, полное время ответа для каналов разной ширины
+BENCH_BANDWIDTHS = {
+    '10 Mbit/s': 10 * 1000 ** 2 / 8,
+    '100 Mbit/s': 100 * 1000 ** 2 / 8,
+    '1 Gbit/s': 1000 ** 3 / 8,
+}
+
+WORDS = [
+    'task', 'fix', 'write', 'review', 'deploy', 'test', 'update', 'docs',
+    'server', 'client', 'database', 'index', 'query', 'cache', 'release', 'bug',
+]
+
+
+def random_text(words: int) -> str:
+    return ' '.join(random.choice(WORDS) for _ in range(words))
+
+
+async def measure(
+        name: str, rounds: int, func: Callable[[int], Awaitable[object]],
+) -> None:
+    latencies = []
+    started = time.perf_counter()
+
+    for i in range(rounds):
+        start = time.perf_counter()
+        await func(i)
+        latencies.append(time.perf_counter() - start)
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+
+    print(f'  {name:<28} {rounds / elapsed:>10.0f} op/s {p50:>9.3f} ms p50 {p99:>9.3f} ms p99')
+
+
+async def bench(name: str, db: storage.Storage) -> None:
+    print(f'=== {name}: {BENCH_TASKS} tasks, {BENCH_ROUNDS} rounds ===')
+
+    user_service = services.UserService(db, cache_size = 1000, cache_ttl = 60, negative_ttl = 2)
+    task_service = services.TaskService(db, max_batch_size = 1000)
+
+    username, password = secrets.token_hex(8), secrets.token_hex(8)
+    await user_service.register(username, password)
+
+    await measure(
+        'login (cached)',
+        BENCH_ROUNDS,
+        lambda _: user_service.login(username, password),
+    )
+
+    # заполнение пачками, в каждом описании есть редкий тег для поиска
+
+    ids = []
+    chunks = [
+        range(offset, min(offset + 1000, BENCH_TASKS))
+        for offset in range(0, BENCH_TASKS, 1000)
+    ]
+
+    async def create_chunk(i: int) -> None:
+        tasks = []
+
+        for _ in chunks[i]:
+            task = await task_service.create_task(
+                username,
+                random_text(3),
+                f'{random_text(8)} tag{random.randrange(1000):03d}',
+                random.choice(list(models.TaskStatus)),
+                random.randrange(1000),
+            )
+            tasks.append(task)
+
+        ids.extend(task.id for task in tasks)
+
+    # create_task пишет по одной задаче, так что это ещё и замер вставки
+    await measure('create (per 1000)', len(chunks), create_chunk)
+
+    await measure(
+        'get',
+        BENCH_ROUNDS,
+        lambda _: task_service.get_task(random.choice(ids), username),
+    )
+    await measure(
+        'get batch (100)',
+        BENCH_ROUNDS,
+        lambda _: task_service.get_tasks(random.sample(ids, 100), username),
+    )
+    await measure(
+        'list top 10',
+        BENCH_ROUNDS,
+        lambda _: task_service.list_tasks(username, 10),
+    )
+    await measure(
+        'list all',
+        max(1, BENCH_ROUNDS // 10),
+        lambda _: task_service.list_tasks(username),
+    )
+    await measure(
+        'search rare',
+        BENCH_ROUNDS,
+        lambda i: task_service.search_tasks(username, f'tag{i % 1000:03d}'),
+    )
+    await measure(
+        'search common',
+        max(1, BENCH_ROUNDS // 10),
+        lambda _: task_service.search_tasks(username, random.choice(WORDS)),
+    )
+    await measure(
+        'update',
+        BENCH_ROUNDS,
+        lambda _: task_service.update_task(
+            random.choice(ids), username, priority = random.randrange(1000),
+        ),
+    )
+    await measure(
+        'delete',
+        min(BENCH_ROUNDS, len(ids)),
+        lambda i: task_service.delete_task(ids[i], username),
+    )
+
+    await db.close()
+
+
+def decompress(encoding: str, data: bytes) -> bytes:
+    if encoding == 'gzip':
+        return zlib.decompress(data, 31)
+
+    return compressor.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def bench_compression() -> None:
+    random.seed(0)
+
+    tasks = [
+        models.Task(
+            id = str(uuid.uuid4()),
+            owner = 'owner',
+            title = random_text(3),
+            description = f'{random_text(8)} tag{random.randrange(1000):03d}',
+            status = random.choice(list(models.TaskStatus)),
+            priority = random.randrange(1000),
+            created_at = datetime.datetime.now(datetime.timezone.utc),
+            updated_at = datetime.datetime.now(datetime.timezone.utc),
+        )
+        for _ in range(BENCH_TASKS)
+    ]
+    content = fastapi.encoders.jsonable_encoder({'tasks': tasks})
+    data = json.dumps(content, ensure_ascii = False, separators = (',', ':')).encode()
+
+    print(f'=== compression: {BENCH_TASKS} tasks, {len(data)} bytes ===')
+
+    header = f'  {"encoding":<10} {"size":>10} {"ratio":>7} {"compress":>10} {"decompress":>11}'
+    header += ''.join(f' {name:>12}' for name in BENCH_BANDWIDTHS)
+    print(header)
+
+    for encoding in ('identity', *compressor.COMPRESSORS):
+        compress_time = decompress_time = 0.0
+        compressed = data
+
+        if encoding != 'identity':
+            rounds = max(1, BENCH_ROUNDS // 20)
+            started = time.perf_counter()
+
+            for _ in range(rounds):
+                stream = compressor.COMPRESSORS[encoding]()
+                compressed = stream.compress(data) + stream.finish()
+
+            compress_time = (time.perf_counter() - started) / rounds
+            started = time.perf_counter()
+
+            for _ in range(rounds):
+                decompress(encoding, compressed)
+
+            decompress_time = (time.perf_counter() - started) / rounds
+
+        # сжатие, передача и распаковка, без задержки сети
+        line = f'  {encoding:<10} {len(compressed):>10} {len(data) / len(compressed):>7.1f}'
+        line += f' {compress_time * 1000:>7.2f} ms {decompress_time * 1000:>8.2f} ms'
+
+        for bandwidth in BENCH_BANDWIDTHS.values():
+            total = compress_time + len(compressed) / bandwidth + decompress_time
+            line += f' {total * 1000:>9.2f} ms'
+
+        print(line)
+
+
+def run_client(args: tuple[str, float]) -> int:
+    cookie, until = args
+
+    session = requests.Session()
+    session.cookies.set('jwt', cookie)
+
+    count = 0
+
+    while time.monotonic() < until:
+        response = session.get(f'http://127.0.0.1:{BENCH_PORT}/tasks/list?count=10')
+        response.raise_for_status()
+
+        count += 1
+
+    return count
+
+
+def bench_workers(workers: int) -> None:
+    # лимиты нагрузки отключены, иначе замеряется admission control
+
+    env = dict(
+        os.environ,
+        WORKERS = str(workers),
+        PORT = str(BENCH_PORT),
+        ADMISSION_RATE = '1000000',
+        ADMISSION_BURST = '1000000',
+        ADMISSION_MAX_IN_FLIGHT = '1000000',
+    )
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py'],
+        cwd = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'),
+        env = env,
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL,
+    )
+
+    try:
+        url = f'http://127.0.0.1:{BENCH_PORT}'
+        started = time.monotonic()
+
+        while True:
+            try:
+                if requests.get(f'{url}/readyz').status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+
+            if time.monotonic() - started > 30:
+                raise TimeoutError('server is not ready')
+
+            time.sleep(0.1)
+
+        session = requests.Session()
+        username, password = secrets.token_hex(8), secrets.token_hex(8)
+        session.post(f'{url}/users/register', json = {'username': username, 'password': password})
+        session.post(f'{url}/users/login', json = {'username': username, 'password': password})
+
+        for i in range(100):
+            session.post(f'{url}/tasks/create', json = {
+                'title': random_text(3),
+                'description': random_text(8),
+                'status': 'Waiting',
+                'priority': i,
+            })
+
+        until = time.monotonic() + BENCH_DURATION
+        args = [(session.cookies['jwt'], until)] * BENCH_CLIENTS
+
+        with multiprocessing.Pool(BENCH_CLIENTS) as pool:
+            total = sum(pool.map(run_client, args))
+
+        print(f'  {workers:>3} workers {total / BENCH_DURATION:>10.0f} req/s')
+    finally:
+        # SIGTERM как при остановке контейнера, проверяет и мягкое завершение
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+async def main() -> None:
+    bench_compression()
+
+    random.seed(0)
+    await bench('memory', memory.MemoryStorage())
+
+    if DATABASE_URI is not None:
+        random.seed(0)
+        await bench('postgres', await database.Database.connect(DATABASE_URI, 10))
+
+    if DATABASE_URI is not None and BENCH_WORKERS is not None:
+        print(f'=== workers: {BENCH_CLIENTS} clients, {BENCH_DURATION} seconds, {os.cpu_count()} cores ===')
+
+        for workers in BENCH_WORKERS.split(','):
+            bench_workers(int(workers))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
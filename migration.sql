@@ -1,15 +1,105 @@
+-- миграция для новой базы, существующую базу со старой схемой
+-- (текстовые id) нужно переводить через src/migrate.py
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'tasks'
+            AND column_name = 'id' AND data_type = 'text'
+    ) THEN
+        RAISE EXCEPTION 'legacy schema, use src/migrate.py';
+    END IF;
+END;
+$$;
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 CREATE TABLE IF NOT EXISTS users (
     username TEXT PRIMARY KEY NOT NULL,
-    hashed_password TEXT NOT NULL
+    hashed_password TEXT NOT NULL,
+    tasks_version BIGINT NOT NULL DEFAULT 0
 );
 
+DO $$
+BEGIN
+    CREATE TYPE task_status AS ENUM ('Unknown', 'Waiting', 'InProgress', 'Done');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END;
+$$;
+
+-- колонки фиксированной длины идут первыми, чтобы не было выравнивания
 CREATE TABLE IF NOT EXISTS tasks (
-    id TEXT PRIMARY KEY NOT NULL,
+    id UUID PRIMARY KEY NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL,
+    deleted_at TIMESTAMPTZ,
+    priority INT NOT NULL,
+    status task_status NOT NULL,
     owner TEXT NOT NULL,
     title TEXT NOT NULL,
-    description TEXT NOT NULL,
-    status TEXT NOT NULL,
+    description TEXT NOT NULL
+);
+
+-- удалённая задача помечается deleted_at и физически удаляется позже
+-- воркером очистки, для баз версии 2 колонка добавляется без перезаписи
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS tasks_owner_idx ON tasks (owner);
+CREATE INDEX IF NOT EXISTS tasks_done_idx ON tasks (updated_at) WHERE status = 'Done';
+-- BRIN не мешает HOT-обновлению (PostgreSQL 16+), так что пометка
+-- не добавляет записей в остальные индексы, а очистке хватает
+-- диапазонов страниц с помеченными задачами
+CREATE INDEX IF NOT EXISTS tasks_deleted_idx ON tasks USING brin (deleted_at);
+
+CREATE TABLE IF NOT EXISTS tasks_archive (
+    id UUID PRIMARY KEY NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL,
+    deleted_at TIMESTAMPTZ,
     priority INT NOT NULL,
-    created_at TIMESTAMP NOT NULL,
-    updated_at TIMESTAMP NOT NULL
+    status task_status NOT NULL,
+    owner TEXT NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL
 );
+
+ALTER TABLE tasks_archive ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS tasks_archive_owner_idx ON tasks_archive (owner);
+CREATE INDEX IF NOT EXISTS tasks_archive_deleted_idx ON tasks_archive USING brin (deleted_at);
+
+CREATE SEQUENCE IF NOT EXISTS task_events_seq;
+
+\ir sql/tasks_changed.sql
+
+CREATE OR REPLACE TRIGGER tasks_inserted
+    AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tasks_changed();
+
+CREATE OR REPLACE TRIGGER tasks_updated
+    AFTER UPDATE ON tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tasks_changed();
+
+CREATE OR REPLACE TRIGGER tasks_deleted
+    AFTER DELETE ON tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tasks_changed();
+
+CREATE OR REPLACE TRIGGER tasks_archive_updated
+    AFTER UPDATE ON tasks_archive
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tasks_changed();
+
+CREATE OR REPLACE TRIGGER tasks_archive_deleted
+    AFTER DELETE ON tasks_archive
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tasks_changed();
+
+INSERT INTO schema_migrations (version) VALUES (3) ON CONFLICT DO NOTHING;
@@ -0,0 +1,57 @@
+CREATE OR REPLACE FUNCTION tasks_changed() RETURNS TRIGGER AS $$
+DECLARE
+    changed_owners TEXT[];
+    changed_ids TEXT[];
+    changed_kinds TEXT[];
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        -- архивация выставляет tasks.change_kind = archive на время транзакции,
+        -- очистка удаляет уже помеченные задачи, их никто не видит
+        SELECT
+            array_agg(owner),
+            array_agg(id),
+            array_agg(coalesce(nullif(current_setting('tasks.change_kind', true), ''), 'delete'))
+        INTO changed_owners, changed_ids, changed_kinds
+        FROM old_rows
+        WHERE deleted_at IS NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        SELECT array_agg(owner), array_agg(id), array_agg('create'::text)
+        INTO changed_owners, changed_ids, changed_kinds
+        FROM new_rows;
+    ELSE
+        -- помеченные задачи больше не обновляются, так что deleted_at
+        -- в новой строке значит что задачу удалили этим запросом
+        SELECT
+            array_agg(owner),
+            array_agg(id),
+            array_agg(CASE WHEN deleted_at IS NULL THEN 'update' ELSE 'delete' END)
+        INTO changed_owners, changed_ids, changed_kinds
+        FROM new_rows;
+    END IF;
+
+    UPDATE users SET tasks_version = tasks_version + 1
+    WHERE username = ANY(changed_owners);
+
+    -- большие пачки (например импорт) не рассылаем построчно,
+    -- вместо этого владелец получает одно событие reset
+    PERFORM pg_notify('task_events', json_build_object(
+        'id', nextval('task_events_seq'),
+        'kind', CASE WHEN c.total > 1000 THEN 'reset' ELSE c.kind END,
+        'owner', c.owner,
+        'task_id', CASE WHEN c.total > 1000 THEN NULL ELSE c.id END
+    )::text)
+    FROM (
+        SELECT
+            owner,
+            id,
+            kind,
+            count(*) OVER (PARTITION BY owner) AS total,
+            row_number() OVER (PARTITION BY owner) AS n
+        FROM
+            unnest(changed_owners, changed_ids, changed_kinds) AS c (owner, id, kind)
+    ) AS c
+    WHERE c.total <= 1000 OR c.n = 1;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import collections
+
+import utils
+
+
+class TokenBucket:
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, cost: float, rate: float, burst: float, now: float) -> float:
+        # возвращает сколько секунд нужно подождать, 0 если токены списаны
+
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+
+        return (cost - self.tokens) / rate
+
+
+class Rejection:
+    def __init__(self, status_code: int, error: str, retry_after: float) -> None:
+        self.status_code = status_code
+        self.error = error
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class AdmissionController:
+    def __init__(
+            self,
+            rate: float,
+            burst: float,
+            max_in_flight: int,
+            route_costs: dict[str, float],
+            long_lived_routes: set[str],
+            max_buckets: int,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.route_costs = route_costs
+        self.long_lived_routes = long_lived_routes
+        self.max_buckets = max_buckets
+
+        self.buckets: collections.OrderedDict[str, TokenBucket] = collections.OrderedDict()
+        self.in_flight = 0
+        self.counters = collections.Counter()
+
+    def get_cost(self, path: str) -> float:
+        return utils.match_route(self.route_costs, path, 1)
+
+    def get_bucket(self, key: str, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[key] = bucket
+
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last = False)
+        else:
+            self.buckets.move_to_end(key)
+
+        return bucket
+
+    def is_exempt(self, path: str) -> bool:
+        # бесплатные маршруты (пробы, метрики) не занимают слот,
+        # поэтому для них не вызываются ни acquire, ни release
+
+        if self.get_cost(path) > 0:
+            return False
+
+        self.counters['exempt'] += 1
+
+        return True
+
+    def holds_slot(self, path: str) -> bool:
+        # долгие подключения (SSE) не работают с базой и только ждут событий,
+        # они платят токены при подключении, но слот не занимают, иначе
+        # открытые подписки вытесняют все остальные запросы
+
+        return path not in self.long_lived_routes
+
+    def acquire(self, key: str, path: str) -> Rejection | None:
+        # None значит что запрос принят, если маршрут занимает слот
+        # (holds_slot), его нужно освободить через release
+
+        cost = self.get_cost(path)
+
+        # сначала глобальный лимит: при перегрузке отказываем сразу,
+        # не тратя токены пользователя
+
+        if self.in_flight >= self.max_in_flight:
+            self.counters['rejected_overloaded'] += 1
+            return Rejection(503, 'server is overloaded', 1)
+
+        now = time.monotonic()
+        wait = self.get_bucket(key, now).take(cost, self.rate, self.burst, now)
+
+        if wait > 0:
+            self.counters['rejected_rate_limited'] += 1
+            return Rejection(429, 'too many requests', wait)
+
+        if self.holds_slot(path):
+            self.in_flight += 1
+
+        self.counters['admitted'] += 1
+
+        return None
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'buckets': len(self.buckets),
+            'admitted': self.counters['admitted'],
+            'exempt': self.counters['exempt'],
+            'rejected_rate_limited': self.counters['rejected_rate_limited'],
+            'rejected_overloaded': self.counters['rejected_overloaded'],
+        }
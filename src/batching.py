@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+
+import models
+import storage
+import deadlines
+
+
+class InsertBatcher:
+    def __init__(self, db: storage.Storage, max_rows: int, max_delay: float) -> None:
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+
+        self.pending: list[tuple[models.Task, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.writes: set[asyncio.Task] = set()
+        self.counters = collections.Counter()
+
+    async def insert(self, task: models.Task) -> None:
+        # задача ждёт пока наберётся max_rows строк или пройдёт max_delay,
+        # потом вся пачка пишется одним INSERT
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self.pending.append((task, future))
+
+        if len(self.pending) >= self.max_rows:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+
+        # shield чтобы отменённый запрос не ломал результат остальным
+        await deadlines.run_bounded(asyncio.shield(future))
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+
+        if len(batch) == 0:
+            return
+
+        write = asyncio.ensure_future(self.write(batch))
+        self.writes.add(write)
+        write.add_done_callback(self.writes.discard)
+
+    async def write(self, batch: list[tuple[models.Task, asyncio.Future]]) -> None:
+        # пачка общая, дедлайн того запроса который её запустил к ней не относится
+        deadlines.current.set(None)
+
+        self.counters['batches'] += 1
+        self.counters['rows'] += len(batch)
+
+        try:
+            await self.db.create_tasks([task for task, _ in batch])
+        except Exception:
+            # одна плохая строка роняет весь INSERT, поэтому пишем по одной,
+            # чтобы каждый запрос получил свою ошибку или успех
+            self.counters['fallbacks'] += 1
+
+            for task, future in batch:
+                try:
+                    await self.db.create_task(task)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(None)
+
+            return
+
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def stop(self) -> None:
+        self.flush()
+
+        if len(self.writes) > 0:
+            await asyncio.gather(*self.writes, return_exceptions = True)
+
+    def get_stats(self) -> dict:
+        return {
+            'pending': len(self.pending),
+            'batches': self.counters['batches'],
+            'rows': self.counters['rows'],
+            'fallbacks': self.counters['fallbacks'],
+        }
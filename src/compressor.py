@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import zlib
+import asyncio
+from typing import AsyncIterator, Callable
+
+import fastapi
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# text/event-stream не сжимается: событие должно уйти клиенту сразу,
+# а не копиться до порога
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+
+class GzipCompressor:
+    def __init__(self) -> None:
+        # wbits 31 это формат gzip, а не голый zlib
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+class ZstdCompressor:
+    def __init__(self) -> None:
+        self.compressor = zstandard.ZstdCompressor(level = ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+# в порядке предпочтения сервера при равных q
+COMPRESSORS = {}
+
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+
+COMPRESSORS['gzip'] = GzipCompressor
+
+
+def choose_encoding(header: str | None) -> str | None:
+    # Accept-Encoding с весами: gzip;q=0.5, zstd, *;q=0
+
+    if header is None:
+        return None
+
+    weights = {}
+
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        weight = 1.0
+
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+
+            if key == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+
+    for encoding in COMPRESSORS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+
+    return best
+
+
+class ResponseCompressor:
+    def __init__(self, min_size: int, offload_size: int) -> None:
+        self.min_size = min_size
+        self.offload_size = offload_size
+
+    async def run(self, func: Callable[[bytes], bytes], data: bytes) -> bytes:
+        # большие куски сжимаются в потоке, zlib и zstd на это время
+        # отпускают GIL, а цикл событий продолжает обслуживать запросы
+
+        if len(data) >= self.offload_size:
+            return await asyncio.to_thread(func, data)
+
+        return func(data)
+
+    def is_compressible(self, response: fastapi.Response) -> bool:
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return False
+
+        if 'content-encoding' in response.headers:
+            return False
+
+        content_type = response.headers.get('content-type', '')
+
+        return content_type.split(';')[0].strip() in COMPRESSIBLE_TYPES
+
+    async def apply(
+            self, accept_encoding: str | None, response: fastapi.Response,
+    ) -> fastapi.Response:
+        # ответ из call_next всегда отдаёт тело через body_iterator, поэтому
+        # подменяется итератор, а заголовки (в том числе cookie) остаются
+
+        if not self.is_compressible(response):
+            return response
+
+        response.headers.append('vary', 'Accept-Encoding')
+
+        encoding = choose_encoding(accept_encoding)
+
+        if encoding is None:
+            return response
+
+        content_length = response.headers.get('content-length')
+
+        if content_length is not None and int(content_length) < self.min_size:
+            return response
+
+        # обычный ответ уже целиком в памяти и читается сразу, у потокового
+        # длины нет, поэтому читаем начало до порога: короткий поток уходит
+        # как есть, а длинный сжимается по мере чтения
+
+        body = response.body_iterator
+        prefix = b''
+        finished = False
+
+        while content_length is not None or len(prefix) < self.min_size:
+            try:
+                chunk = await body.__anext__()
+            except StopAsyncIteration:
+                finished = True
+                break
+
+            prefix += chunk
+
+        if finished and len(prefix) < self.min_size:
+            response.body_iterator = iterate(prefix)
+            return response
+
+        compressor = COMPRESSORS[encoding]()
+
+        response.headers['content-encoding'] = encoding
+
+        # представление другое, поэтому ETag становится слабым,
+        # If-None-Match сравнивает слабо и 304 продолжает работать
+        etag = response.headers.get('etag')
+
+        if etag is not None and not etag.startswith('W/'):
+            response.headers['etag'] = f'W/{etag}'
+
+        if finished:
+            data = await self.run(compressor.compress, prefix) + compressor.finish()
+
+            response.headers['content-length'] = str(len(data))
+            response.body_iterator = iterate(data)
+
+            return response
+
+        if 'content-length' in response.headers:
+            del response.headers['content-length']
+
+        response.body_iterator = self.compress_stream(compressor, prefix, body)
+
+        return response
+
+    async def compress_stream(
+            self, compressor: GzipCompressor | ZstdCompressor, prefix: bytes, body: AsyncIterator,
+    ) -> AsyncIterator[bytes]:
+        # без принудительного сброса: сжатые данные уходят как только
+        # компрессор накопит блок, мелкие куски (строки COPY) сжимаются вместе
+
+        data = await self.run(compressor.compress, prefix)
+
+        if len(data) > 0:
+            yield data
+
+        async for chunk in body:
+            data = await self.run(compressor.compress, chunk)
+
+            if len(data) > 0:
+                yield data
+
+        yield compressor.finish()
+
+
+async def iterate(data: bytes) -> AsyncIterator[bytes]:
+    yield data
@@ -1,27 +1,115 @@
 #!/usr/bin/env python3
 
+import uuid
+import datetime
+from typing import AsyncIterator
+
 import psycopg
+import psycopg_pool
 
 import models
-
-
-class UserAlreadyExistsError(Exception):
-    pass
+import storage
+import deadlines
+
+
+# самые частые запросы, они заранее подготавливаются на каждом
+# соединении пула (см warm_connection)
+FIND_USER_SQL = '''
+SELECT
+    username, hashed_password
+FROM
+    users
+WHERE
+    username = %s
+'''
+FIND_TASK_SQL = '''
+SELECT
+    id, owner, title, description, status, priority, created_at, updated_at
+FROM
+    tasks
+WHERE
+    id = %s AND deleted_at IS NULL
+'''
+FIND_TASK_WITH_ARCHIVE_SQL = FIND_TASK_SQL + '''
+UNION ALL
+SELECT
+    id, owner, title, description, status, priority, created_at, updated_at
+FROM
+    tasks_archive
+WHERE
+    id = %s AND deleted_at IS NULL
+'''
+FIND_TASKS_VERSION_SQL = '''
+SELECT
+    tasks_version
+FROM
+    users
+WHERE
+    username = %s
+'''
+
+WARM_QUERIES = [
+    (FIND_USER_SQL, ('',)),
+    (FIND_TASK_SQL, (str(uuid.UUID(int = 0)),)),
+    (FIND_TASK_WITH_ARCHIVE_SQL, (str(uuid.UUID(int = 0)), str(uuid.UUID(int = 0)))),
+    (FIND_TASKS_VERSION_SQL, ('',)),
+]
+
+
+async def warm_connection(conn: psycopg.AsyncConnection) -> None:
+    # вызывается пулом для каждого нового соединения, так что первые
+    # запросы после старта или переподключения не платят за разбор и план
+
+    for sql, values in WARM_QUERIES:
+        await conn.execute(sql, values, prepare = True)
+
+
+def create_task_from_row(row: tuple) -> models.Task:
+    id, owner, title, description, status, priority, created_at, updated_at = row
+
+    return models.Task(
+        str(id),
+        owner,
+        title,
+        description,
+        models.TaskStatus(status),
+        priority,
+        created_at,
+        updated_at,
+    )
 
 
 class Database:
-    def __init__(self, conn: psycopg.AsyncConnection) -> None:
-        self.conn = conn
+    def __init__(self, pool: psycopg_pool.AsyncConnectionPool) -> None:
+        self.pool = pool
 
     @staticmethod
-    async def connect(database_uri: str) -> 'Database':
-        conn = await psycopg.AsyncConnection.connect(
+    async def connect(database_uri: str, pool_size: int) -> 'Database':
+        # COPY держит соединение на всё время выгрузки, поэтому нужен пул,
+        # а не одно общее соединение. Запросы ограничены дедлайном запроса
+        # (см deadlines.bounded), ожидание соединения из пула тоже
+
+        pool = psycopg_pool.AsyncConnectionPool(
             database_uri,
-            autocommit = True,
+            min_size = pool_size,
+            max_size = pool_size,
+            kwargs = {'autocommit': True},
+            configure = warm_connection,
+            open = False,
         )
+        await pool.open(wait = True)
+
+        return Database(pool)
 
-        return Database(conn)
+    async def close(self) -> None:
+        await self.pool.close()
+
+    @deadlines.bounded
+    async def ping(self) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute('SELECT 1')
     
+    @deadlines.bounded
     async def create_user(self, user: models.User) -> None:
         sql = '''
         INSERT INTO
@@ -30,31 +118,25 @@ class Database:
             (%s, %s)
         '''
 
-        cursor = self.conn.cursor()
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
 
-        try:
-            values = (
-                user.username,
-                user.hashed_password,
-            )
-            await cursor.execute(sql, values)
-        except psycopg.errors.UniqueViolation:
-            raise UserAlreadyExistsError(f'user {user.username} already exists')
+            try:
+                values = (
+                    user.username,
+                    user.hashed_password,
+                )
+                await cursor.execute(sql, values)
+            except psycopg.errors.UniqueViolation:
+                raise storage.UserAlreadyExistsError(f'user {user.username} already exists')
 
+    @deadlines.bounded
     async def find_user_by_username(self, username: str) -> models.User | None:
-        sql = '''
-        SELECT
-            username, hashed_password
-        FROM
-            users
-        WHERE
-            username = %s
-        '''
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(FIND_USER_SQL, (username,))
 
-        cursor = self.conn.cursor()
-        await cursor.execute(sql, (username,))
-
-        row = await cursor.fetchone()
+            row = await cursor.fetchone()
 
         if row is None:
             return None
@@ -63,6 +145,7 @@ class Database:
 
         return models.User(username, hashed_password)
 
+    @deadlines.bounded
     async def create_task(self, task: models.Task) -> None:
         sql = '''
         INSERT INTO
@@ -71,83 +154,196 @@ class Database:
             (%s, %s, %s, %s, %s, %s, %s, %s)
         '''
 
-        cursor = self.conn.cursor()
-
-        values = (
-            task.id,
-            task.owner,
-            task.title,
-            task.description,
-            task.status,
-            task.priority,
-            task.created_at,
-            task.updated_at,
-        )
-        await cursor.execute(sql, values)
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            values = (
+                task.id,
+                task.owner,
+                task.title,
+                task.description,
+                task.status,
+                task.priority,
+                task.created_at,
+                task.updated_at,
+            )
+            await cursor.execute(sql, values)
+
+    @deadlines.bounded
+    async def create_tasks(self, tasks: list[models.Task]) -> None:
+        rows = ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(tasks))
+
+        sql = f'''
+        INSERT INTO
+            tasks (id, owner, title, description, status, priority, created_at, updated_at)
+        VALUES
+            {rows}
+        '''
+
+        values = []
+
+        for task in tasks:
+            values.extend((
+                task.id,
+                task.owner,
+                task.title,
+                task.description,
+                task.status,
+                task.priority,
+                task.created_at,
+                task.updated_at,
+            ))
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, values)
+
+    @deadlines.bounded
+    async def find_task_by_id(self, id: str, include_archived: bool = False) -> models.Task | None:
+        sql = FIND_TASK_SQL
+        values = (id,)
+
+        if include_archived:
+            sql = FIND_TASK_WITH_ARCHIVE_SQL
+            values = (id, id)
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, values)
+
+            row = await cursor.fetchone()
+
+        if row is None:
+            return None
+        
+        return create_task_from_row(row)
+
+    @deadlines.bounded
+    async def find_top_tasks_by_owner(
+            self, owner: str, count: int | None, include_archived: bool = False,
+    ) -> list[models.Task]:
+        # LIMIT NULL означает без ограничения
 
-    async def find_task_by_id(self, id: str) -> models.Task | None:
         sql = '''
         SELECT
             id, owner, title, description, status, priority, created_at, updated_at
         FROM
             tasks
         WHERE
-            id = %s
+            owner = %s AND deleted_at IS NULL
         '''
+        values = [owner]
+
+        if include_archived:
+            sql += '''
+            UNION ALL
+            SELECT
+                id, owner, title, description, status, priority, created_at, updated_at
+            FROM
+                tasks_archive
+            WHERE
+                owner = %s AND deleted_at IS NULL
+            '''
+            values.append(owner)
+
+        sql = f'''
+        SELECT
+            *
+        FROM
+            ({sql}) AS t
+        ORDER BY
+            priority DESC
+        LIMIT
+            %s
+        '''
+        values.append(count)
 
-        cursor = self.conn.cursor()
-        await cursor.execute(sql, (id,))
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, values)
 
-        row = await cursor.fetchone()
+            rows = await cursor.fetchall()
 
-        if row is None:
-            return None
-        
-        id, owner, title, description, status, priority, created_at, updated_at = row
-        
-        return models.Task(
-            id,
-            owner,
-            title,
-            description,
-            status,
-            priority,
-            created_at,
-            updated_at,
-        )
+        return [create_task_from_row(row) for row in rows]
+
+    @deadlines.bounded
+    async def search_tasks_by_owner(
+            self, owner: str, text: str, include_archived: bool = False,
+    ) -> list[models.Task]:
+        # strpos ищет подстроку как есть, без спецсимволов LIKE
 
-    async def find_tasks_by_owner(self, owner: str) -> list[models.Task]:
         sql = '''
         SELECT
             id, owner, title, description, status, priority, created_at, updated_at
         FROM
             tasks
         WHERE
-            owner = %s
+            owner = %s AND deleted_at IS NULL
+                AND (strpos(title, %s) > 0 OR strpos(description, %s) > 0)
         '''
+        values = [owner, text, text]
+
+        if include_archived:
+            sql += '''
+            UNION ALL
+            SELECT
+                id, owner, title, description, status, priority, created_at, updated_at
+            FROM
+                tasks_archive
+            WHERE
+                owner = %s AND deleted_at IS NULL
+                AND (strpos(title, %s) > 0 OR strpos(description, %s) > 0)
+            '''
+            values.extend((owner, text, text))
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, values)
 
-        cursor = self.conn.cursor()
-        await cursor.execute(sql, (owner,))
+            rows = await cursor.fetchall()
 
-        rows = await cursor.fetchall()
-        tasks = []
+        return [create_task_from_row(row) for row in rows]
 
-        for row in rows:
-            id, owner, title, description, status, priority, created_at, updated_at = row
-            task = models.Task(
-                id,
-                owner,
-                title,
-                description,
-                status,
-                priority,
-                created_at,
-                updated_at,
-            )
-            tasks.append(task)
+    @deadlines.bounded
+    async def find_tasks_by_ids(self, ids: list[str], owner: str) -> list[models.Task]:
+        sql = '''
+        SELECT
+            id, owner, title, description, status, priority, created_at, updated_at
+        FROM
+            tasks
+        WHERE
+            id = ANY(%s::uuid[]) AND owner = %s AND deleted_at IS NULL
+        UNION ALL
+        SELECT
+            id, owner, title, description, status, priority, created_at, updated_at
+        FROM
+            tasks_archive
+        WHERE
+            id = ANY(%s::uuid[]) AND owner = %s AND deleted_at IS NULL
+        '''
 
-        return tasks
-    
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, (ids, owner, ids, owner))
+
+            rows = await cursor.fetchall()
+
+        return [create_task_from_row(row) for row in rows]
+
+    @deadlines.bounded
+    async def find_tasks_version(self, owner: str) -> int:
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(FIND_TASKS_VERSION_SQL, (owner,))
+
+            row = await cursor.fetchone()
+
+        if row is None:
+            return 0
+
+        return row[0]
+
+    @deadlines.bounded
     async def update_task_by_id(self, id: str, task: models.Task) -> None:
         sql = '''
         UPDATE
@@ -161,30 +357,284 @@ class Database:
             created_at = %s,
             updated_at = %s
         WHERE
-            id = %s
+            id = %s AND deleted_at IS NULL
+        '''
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            values = (
+                task.owner,
+                task.title,
+                task.description,
+                task.status,
+                task.priority,
+                task.created_at,
+                task.updated_at,
+                id,
+            )
+            await cursor.execute(sql, values)
+
+    @deadlines.bounded
+    async def update_tasks_by_ids(
+            self,
+            owner: str,
+            patches: list[models.TaskPatch],
+            updated_at: datetime.datetime,
+    ) -> list[str]:
+        # один UPDATE на всю пачку, поля которых нет в патче остаются как есть
+
+        rows = ', '.join(['(%s::uuid, %s, %s, %s::task_status, %s::int)'] * len(patches))
+
+        sql = f'''
+        UPDATE
+            tasks AS t
+        SET
+            title = COALESCE(v.title, t.title),
+            description = COALESCE(v.description, t.description),
+            status = COALESCE(v.status, t.status),
+            priority = COALESCE(v.priority, t.priority),
+            updated_at = %s
+        FROM
+            (VALUES {rows}) AS v (id, title, description, status, priority)
+        WHERE
+            t.id = v.id AND t.owner = %s AND t.deleted_at IS NULL
+        RETURNING
+            t.id
         '''
 
-        cursor = self.conn.cursor()
-
-        values = (
-            task.owner,
-            task.title,
-            task.description,
-            task.status,
-            task.priority,
-            task.created_at,
-            task.updated_at,
-            id,
+        values = [updated_at]
+
+        for patch in patches:
+            values.extend((
+                patch.id,
+                patch.title,
+                patch.description,
+                patch.status,
+                patch.priority,
+            ))
+
+        values.append(owner)
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, values)
+
+            rows = await cursor.fetchall()
+
+        return [str(id) for id, in rows]
+
+    @deadlines.bounded
+    async def delete_tasks_by_ids(self, ids: list[str], owner: str) -> list[str]:
+        # задачи только помечаются удалёнными одним UPDATE, обычно это
+        # HOT-обновление без новых записей в индексах (см migration.sql),
+        # а сами строки потом пачками удаляет purge_deleted_tasks
+
+        sql = '''
+        WITH archived AS (
+            UPDATE
+                tasks_archive
+            SET
+                deleted_at = %s
+            WHERE
+                id = ANY(%s::uuid[]) AND owner = %s AND deleted_at IS NULL
+            RETURNING
+                id
+        ), hot AS (
+            UPDATE
+                tasks
+            SET
+                deleted_at = %s
+            WHERE
+                id = ANY(%s::uuid[]) AND owner = %s AND deleted_at IS NULL
+            RETURNING
+                id
         )
-        await cursor.execute(sql, values)
+        SELECT id FROM archived
+        UNION ALL
+        SELECT id FROM hot
+        '''
+
+        deleted_at = datetime.datetime.now(datetime.timezone.utc)
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, (deleted_at, ids, owner, deleted_at, ids, owner))
+
+            rows = await cursor.fetchall()
+
+        return [str(id) for id, in rows]
+
+    async def delete_task_by_id(self, id: str, owner: str) -> bool:
+        deleted = await self.delete_tasks_by_ids([id], owner)
+
+        return len(deleted) > 0
+
+    @deadlines.bounded
+    async def archive_done_tasks(
+            self, updated_before: datetime.datetime, limit: int,
+    ) -> int:
+        # перенос одним запросом, SKIP LOCKED позволяет нескольким воркерам
+        # архивировать параллельно не мешая друг другу
 
-    async def delete_task_by_id(self, id: str) -> None:
         sql = '''
-        DELETE FROM
+        WITH moved AS (
+            DELETE FROM
+                tasks
+            WHERE
+                id IN (
+                    SELECT
+                        id
+                    FROM
+                        tasks
+                    WHERE
+                        status = 'Done' AND updated_at < %s AND deleted_at IS NULL
+                    LIMIT
+                        %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            RETURNING
+                id, owner, title, description, status, priority, created_at, updated_at
+        )
+        INSERT INTO
+            tasks_archive (id, owner, title, description, status, priority, created_at, updated_at, archived_at)
+        SELECT
+            id, owner, title, description, status, priority, created_at, updated_at, %s
+        FROM
+            moved
+        '''
+
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                cursor = conn.cursor()
+
+                # триггер на tasks рассылает событие archive вместо delete
+                await cursor.execute(
+                    "SELECT set_config('tasks.change_kind', 'archive', true)",
+                )
+                archived_at = datetime.datetime.now(datetime.timezone.utc)
+                await cursor.execute(sql, (updated_before, limit, archived_at))
+
+                return cursor.rowcount
+
+    @deadlines.bounded
+    async def purge_deleted_tasks(
+            self, deleted_before: datetime.datetime, limit: int,
+    ) -> int:
+        # помеченные строки находятся по BRIN-индексу на deleted_at,
+        # каждая таблица чистится пачкой не больше limit строк
+
+        sql = '''
+        WITH archived AS (
+            DELETE FROM
+                tasks_archive
+            WHERE
+                id IN (
+                    SELECT
+                        id
+                    FROM
+                        tasks_archive
+                    WHERE
+                        deleted_at < %s
+                    LIMIT
+                        %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            RETURNING
+                id
+        ), hot AS (
+            DELETE FROM
+                tasks
+            WHERE
+                id IN (
+                    SELECT
+                        id
+                    FROM
+                        tasks
+                    WHERE
+                        deleted_at < %s
+                    LIMIT
+                        %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            RETURNING
+                id
+        )
+        SELECT
+            (SELECT count(*) FROM archived) + (SELECT count(*) FROM hot)
+        '''
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            await cursor.execute(sql, (deleted_before, limit, deleted_before, limit))
+
+            row = await cursor.fetchone()
+
+        return row[0]
+
+    async def export_tasks(self, owner: str, format: str) -> AsyncIterator[bytes]:
+        query = '''
+        SELECT
+            id, title, description, status, priority, created_at, updated_at
+        FROM
             tasks
         WHERE
-            id = %s
+            owner = %s AND deleted_at IS NULL
+        UNION ALL
+        SELECT
+            id, title, description, status, priority, created_at, updated_at
+        FROM
+            tasks_archive
+        WHERE
+            owner = %s AND deleted_at IS NULL
         '''
 
-        cursor = self.conn.cursor()
-        await cursor.execute(sql, (id,))
+        if format == 'csv':
+            sql = f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)'
+        elif format == 'ndjson':
+            sql = f'COPY (SELECT row_to_json(t) FROM ({query}) AS t) TO STDOUT'
+        else:
+            raise ValueError(f'unknown format {format}')
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            async with cursor.copy(sql, (owner, owner)) as copy:
+                async for data in copy:
+                    if format == 'ndjson':
+                        # сервер шлёт по строке на сообщение, а в json из
+                        # row_to_json текстовый COPY экранирует только слэши
+                        data = bytes(data).replace(b'\\\\', b'\\')
+
+                    yield bytes(data)
+
+    async def import_tasks(self, tasks: AsyncIterator[models.Task]) -> int:
+        sql = '''
+        COPY
+            tasks (id, owner, title, description, status, priority, created_at, updated_at)
+        FROM
+            STDIN
+        '''
+
+        count = 0
+
+        async with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            async with cursor.copy(sql) as copy:
+                async for task in tasks:
+                    values = (
+                        task.id,
+                        task.owner,
+                        task.title,
+                        task.description,
+                        task.status,
+                        task.priority,
+                        task.created_at,
+                        task.updated_at,
+                    )
+                    await copy.write_row(values)
+
+                    count += 1
+
+        return count
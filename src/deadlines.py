@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import asyncio
+import functools
+import contextvars
+from typing import Awaitable, Callable
+
+import utils
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, expires_at: float) -> None:
+        self.expires_at = expires_at
+        self.cancelled = asyncio.Event()
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def detach(self) -> 'Deadline':
+        # тот же срок, но отмена исходного запроса на копию не влияет
+
+        return Deadline(self.expires_at)
+
+    async def run(self, awaitable: Awaitable) -> object:
+        task = asyncio.ensure_future(awaitable)
+
+        if self.remaining() <= 0 or self.cancelled.is_set():
+            task.cancel()
+            raise DeadlineExceededError('deadline exceeded')
+
+        waiter = asyncio.ensure_future(self.cancelled.wait())
+
+        try:
+            done, _ = await asyncio.wait(
+                {task, waiter},
+                timeout = self.remaining(),
+                return_when = asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            waiter.cancel()
+
+            if not task.done():
+                # psycopg при отмене сам отменяет запрос на сервере
+                task.cancel()
+
+        if task in done:
+            return task.result()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        if self.cancelled.is_set():
+            raise DeadlineExceededError('client disconnected')
+
+        raise DeadlineExceededError('deadline exceeded')
+
+
+current: contextvars.ContextVar[Deadline | None] = contextvars.ContextVar(
+    'deadline', default = None,
+)
+
+
+async def run_bounded(awaitable: Awaitable) -> object:
+    deadline = current.get()
+
+    if deadline is None:
+        return await awaitable
+
+    return await deadline.run(awaitable)
+
+
+def bounded(func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_bounded(func(*args, **kwargs))
+
+    return wrapper
+
+
+class DeadlinePolicy:
+    def __init__(
+            self,
+            default_timeout: float,
+            max_timeout: float,
+            route_timeouts: dict[str, float | None],
+    ) -> None:
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.route_timeouts = route_timeouts
+
+    def create_deadline(self, path: str, header: str | None) -> Deadline | None:
+        # None в route_timeouts значит что у маршрута нет дедлайна (стриминг),
+        # заголовок может задать свой таймаут, но не больше max_timeout
+
+        timeout = utils.match_route(self.route_timeouts, path, self.default_timeout)
+
+        if timeout is None:
+            return None
+
+        if header is not None:
+            try:
+                timeout = float(header)
+            except Exception:
+                raise TypeError('invalid request timeout')
+
+            # float() принимает и nan, и inf, nan проходит проверку на знак
+            if not math.isfinite(timeout) or timeout <= 0:
+                raise ValueError('request timeout is not positive')
+
+        timeout = min(timeout, self.max_timeout)
+
+        return Deadline(time.monotonic() + timeout)
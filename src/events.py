@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import json
+import asyncio
+import logging
+import collections
+import dataclasses
+
+import psycopg
+
+import workers
+
+
+CHANNEL = 'task_events'
+RECONNECT_DELAY = 1
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Event:
+    id: int
+    kind: str
+    owner: str
+    task_id: str
+
+
+class Subscription:
+    def __init__(self, owner: str, queue_size: int) -> None:
+        self.owner = owner
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+    def push(self, event: Event) -> None:
+        if self.overflowed:
+            return
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflow()
+
+    def overflow(self) -> None:
+        # клиент не успевает читать (или пропустил события), поэтому выкидываем
+        # очередь и просим его переподключиться с последним полученным id
+
+        self.overflowed = True
+
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        self.queue.put_nowait(None)
+
+    async def get(self) -> Event | None:
+        return await self.queue.get()
+
+
+class EventBroker(workers.Worker):
+    def __init__(self, database_uri: str, queue_size: int, history_size: int) -> None:
+        super().__init__()
+
+        self.database_uri = database_uri
+        self.queue_size = queue_size
+
+        self.subscribers: dict[str, set[Subscription]] = {}
+
+        # события в порядке доставки. id выдаёт триггер при записи, а NOTIFY
+        # приходит в порядке коммитов, так что id в истории не упорядочены
+        self.history: collections.deque[Event] = collections.deque(maxlen = history_size)
+
+    async def run(self) -> None:
+        # одно LISTEN-соединение на воркер, события раздаются локальным подписчикам
+
+        while True:
+            try:
+                conn = await psycopg.AsyncConnection.connect(
+                    self.database_uri,
+                    autocommit = True,
+                )
+
+                async with conn:
+                    await conn.execute(f'LISTEN {CHANNEL}')
+
+                    self.reset()
+
+                    async for notify in conn.notifies():
+                        self.publish(Event(**json.loads(notify.payload)))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('task events listener failed')
+
+            # пока соединения нет события теряются, продолжать по истории нельзя
+            self.history.clear()
+
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def reset(self) -> None:
+        self.history.clear()
+
+        for subscriptions in self.subscribers.values():
+            for subscription in subscriptions:
+                subscription.overflow()
+
+    def publish(self, event: Event) -> None:
+        self.history.append(event)
+
+        for subscription in self.subscribers.get(event.owner, ()):
+            subscription.push(event)
+
+    def subscribe(self, owner: str, last_event_id: int = None) -> Subscription:
+        subscription = Subscription(owner, self.queue_size)
+
+        if last_event_id is not None:
+            missed = self.find_missed(owner, last_event_id)
+
+            if missed is None:
+                subscription.overflow()
+            else:
+                for event in missed:
+                    subscription.push(event)
+
+        self.subscribers.setdefault(owner, set()).add(subscription)
+
+        return subscription
+
+    def find_missed(self, owner: str, last_event_id: int) -> list[Event] | None:
+        # продолжаем с места последнего события клиента в истории, а не по
+        # сравнению id. Если его там нет (вытеснено или пришло до подключения)
+        # пропущенное восстановить нельзя, возвращается None
+
+        missed = []
+
+        for event in reversed(self.history):
+            if event.id == last_event_id:
+                missed.reverse()
+                return missed
+
+            if event.owner == owner:
+                missed.append(event)
+
+        return None
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscriptions = self.subscribers.get(subscription.owner)
+
+        if subscriptions is None:
+            return
+
+        subscriptions.discard(subscription)
+
+        if len(subscriptions) == 0:
+            del self.subscribers[subscription.owner]
+
+
+def format_event(event: Event) -> str:
+    data = json.dumps({'task_id': event.task_id})
+
+    return f'id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n'
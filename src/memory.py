@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+import io
+import csv
+import copy
+import json
+import heapq
+import bisect
+import datetime
+import itertools
+import collections
+import dataclasses
+from typing import AsyncIterator, Callable
+
+import models
+import events
+import storage
+import deadlines
+
+
+GRAM_SIZE = 3
+EXPORT_CHUNK_SIZE = 1000
+# как в триггере tasks_changed, большие пачки дают одно событие reset
+MAX_EVENTS_PER_OWNER = 1000
+
+
+def split_grams(text: str) -> set[str]:
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+def task_grams(task: models.Task) -> set[str]:
+    return split_grams(task.title) | split_grams(task.description)
+
+
+class OwnerTasks:
+    # задачи одного владельца в одной таблице: ключи отсортированы по
+    # убыванию приоритета (потом по порядку вставки) для листинга,
+    # а триграммы названия и описания ведут на задачи для поиска
+
+    def __init__(self) -> None:
+        self.tasks: dict[str, models.Task] = {}
+        self.keys: dict[str, tuple[int, int, str]] = {}
+        self.order: list[tuple[int, int, str]] = []
+        self.grams: dict[str, set[str]] = {}
+
+    def add(self, task: models.Task, seq: int) -> None:
+        key = (-task.priority, seq, task.id)
+
+        self.tasks[task.id] = task
+        self.keys[task.id] = key
+        bisect.insort(self.order, key)
+
+        for gram in task_grams(task):
+            self.grams.setdefault(gram, set()).add(task.id)
+
+    def remove(self, id: str) -> tuple[models.Task, int]:
+        task = self.tasks.pop(id)
+        key = self.keys.pop(id)
+
+        del self.order[bisect.bisect_left(self.order, key)]
+
+        for gram in task_grams(task):
+            ids = self.grams[gram]
+            ids.discard(id)
+
+            if len(ids) == 0:
+                del self.grams[gram]
+
+        return task, key[1]
+
+    def search(self, text: str) -> list[tuple[int, int, str]]:
+        # кандидаты это пересечение списков по триграммам запроса,
+        # короткий запрос проверяется по всем задачам. Порядок вставки,
+        # как у последовательного чтения таблицы в PostgreSQL
+
+        if len(text) < GRAM_SIZE:
+            candidates = self.tasks.keys()
+        else:
+            postings = sorted(
+                (self.grams.get(gram, set()) for gram in split_grams(text)),
+                key = len,
+            )
+            candidates = set.intersection(*postings)
+
+        keys = []
+
+        for id in candidates:
+            task = self.tasks[id]
+
+            if text in task.title or text in task.description:
+                keys.append(self.keys[id])
+
+        keys.sort(key = lambda key: key[1])
+
+        return keys
+
+
+class Table:
+    def __init__(self) -> None:
+        self.owners: dict[str, OwnerTasks] = {}
+        self.index: dict[str, str] = {}
+        # помеченные удалёнными задачи в порядке удаления, чтениям не видны
+        self.deleted: dict[str, tuple[models.Task, int, datetime.datetime]] = {}
+
+    def get(self, id: str) -> models.Task | None:
+        owner = self.index.get(id)
+
+        if owner is None:
+            return None
+
+        return self.owners[owner].tasks[id]
+
+    def get_owner(self, owner: str) -> OwnerTasks:
+        return self.owners.get(owner) or OwnerTasks()
+
+    def add(self, task: models.Task, seq: int) -> None:
+        self.index[task.id] = task.owner
+        self.owners.setdefault(task.owner, OwnerTasks()).add(task, seq)
+
+    def remove(self, id: str) -> tuple[models.Task, int]:
+        owner = self.index.pop(id)
+        owner_tasks = self.owners[owner]
+
+        result = owner_tasks.remove(id)
+
+        if len(owner_tasks.tasks) == 0:
+            del self.owners[owner]
+
+        return result
+
+    def replace(self, task: models.Task) -> None:
+        # ключ сортировки и триграммы зависят от полей, поэтому задача
+        # переиндексируется целиком, но сохраняет место среди равных
+
+        _, seq = self.remove(task.id)
+        self.add(task, seq)
+
+    def tombstone(self, id: str, deleted_at: datetime.datetime) -> models.Task:
+        task, seq = self.remove(id)
+        self.deleted[id] = (task, seq, deleted_at)
+
+        return task
+
+    def purge(self, deleted_before: datetime.datetime, limit: int) -> int:
+        # самые старые пометки в начале словаря
+
+        ids = []
+
+        for id, (_, _, deleted_at) in self.deleted.items():
+            if len(ids) >= limit or deleted_at >= deleted_before:
+                break
+
+            ids.append(id)
+
+        for id in ids:
+            del self.deleted[id]
+
+        return len(ids)
+
+
+class MemoryStorage:
+    # данные живут в памяти процесса и пропадают при перезапуске,
+    # годится для тестов и бенчмарков без PostgreSQL
+
+    def __init__(self) -> None:
+        self.users: dict[str, models.User] = {}
+        self.versions = collections.Counter()
+
+        self.tasks = Table()
+        self.archive = Table()
+        self.seq = itertools.count()
+
+        # вместо LISTEN/NOTIFY события отдаются подписчикам напрямую
+        self.event_ids = itertools.count(1)
+        self.listeners: list[Callable[[events.Event], None]] = []
+
+    async def close(self) -> None:
+        pass
+
+    async def ping(self) -> None:
+        pass
+
+    def notify(self, kind: str, tasks: list[models.Task]) -> None:
+        # то же что делает триггер tasks_changed на одну операцию
+
+        changed = {}
+
+        for task in tasks:
+            changed.setdefault(task.owner, []).append(task.id)
+
+        for owner, ids in changed.items():
+            if owner in self.users:
+                self.versions[owner] += 1
+
+            if len(ids) > MAX_EVENTS_PER_OWNER:
+                owner_events = [events.Event(next(self.event_ids), 'reset', owner, None)]
+            else:
+                owner_events = [
+                    events.Event(next(self.event_ids), kind, owner, id) for id in ids
+                ]
+
+            for event in owner_events:
+                for listener in self.listeners:
+                    listener(event)
+
+    @deadlines.bounded
+    async def create_user(self, user: models.User) -> None:
+        if user.username in self.users:
+            raise storage.UserAlreadyExistsError(f'user {user.username} already exists')
+
+        self.users[user.username] = copy.copy(user)
+
+    @deadlines.bounded
+    async def find_user_by_username(self, username: str) -> models.User | None:
+        user = self.users.get(username)
+
+        if user is None:
+            return None
+
+        return copy.copy(user)
+
+    async def create_task(self, task: models.Task) -> None:
+        await self.create_tasks([task])
+
+    @deadlines.bounded
+    async def create_tasks(self, tasks: list[models.Task]) -> None:
+        self.insert_tasks(tasks)
+
+    def insert_tasks(self, tasks: list[models.Task]) -> None:
+        # как один INSERT: либо вставляется вся пачка, либо ничего
+
+        ids = set()
+
+        for task in tasks:
+            if task.id in ids or self.tasks.get(task.id) is not None or task.id in self.tasks.deleted:
+                raise ValueError(f'task {task.id} already exists')
+
+            ids.add(task.id)
+
+        tasks = [copy.copy(task) for task in tasks]
+
+        for task in tasks:
+            self.tasks.add(task, next(self.seq))
+
+        self.notify('create', tasks)
+
+    @deadlines.bounded
+    async def find_task_by_id(
+            self, id: str, include_archived: bool = False,
+    ) -> models.Task | None:
+        task = self.tasks.get(id)
+
+        if task is None and include_archived:
+            task = self.archive.get(id)
+
+        if task is None:
+            return None
+
+        return copy.copy(task)
+
+    @deadlines.bounded
+    async def find_top_tasks_by_owner(
+            self, owner: str, count: int | None, include_archived: bool = False,
+    ) -> list[models.Task]:
+        hot = self.tasks.get_owner(owner)
+        archived = self.archive.get_owner(owner)
+
+        if include_archived:
+            keys = itertools.islice(heapq.merge(hot.order, archived.order), count)
+        else:
+            keys = hot.order[:count]
+
+        return [self.get_task_by_key(key, hot, archived) for key in keys]
+
+    @deadlines.bounded
+    async def search_tasks_by_owner(
+            self, owner: str, text: str, include_archived: bool = False,
+    ) -> list[models.Task]:
+        hot = self.tasks.get_owner(owner)
+        archived = self.archive.get_owner(owner)
+
+        keys = hot.search(text)
+
+        if include_archived:
+            keys += archived.search(text)
+
+        return [self.get_task_by_key(key, hot, archived) for key in keys]
+
+    def get_task_by_key(
+            self, key: tuple[int, int, str], hot: OwnerTasks, archived: OwnerTasks,
+    ) -> models.Task:
+        _, _, id = key
+        task = hot.tasks.get(id) or archived.tasks[id]
+
+        return copy.copy(task)
+
+    @deadlines.bounded
+    async def find_tasks_by_ids(self, ids: list[str], owner: str) -> list[models.Task]:
+        tasks = []
+
+        for id in set(ids):
+            task = self.tasks.get(id) or self.archive.get(id)
+
+            if task is not None and task.owner == owner:
+                tasks.append(copy.copy(task))
+
+        return tasks
+
+    @deadlines.bounded
+    async def find_tasks_version(self, owner: str) -> int:
+        return self.versions[owner]
+
+    @deadlines.bounded
+    async def update_task_by_id(self, id: str, task: models.Task) -> None:
+        if self.tasks.get(id) is None:
+            return
+
+        task = dataclasses.replace(task, id = id)
+
+        self.tasks.replace(task)
+        self.notify('update', [task])
+
+    @deadlines.bounded
+    async def update_tasks_by_ids(
+            self,
+            owner: str,
+            patches: list[models.TaskPatch],
+            updated_at: datetime.datetime,
+    ) -> list[str]:
+        updated = []
+
+        for patch in patches:
+            task = self.tasks.get(patch.id)
+
+            if task is None or task.owner != owner:
+                continue
+
+            task = dataclasses.replace(task, updated_at = updated_at)
+
+            if patch.title is not None:
+                task.title = patch.title
+
+            if patch.description is not None:
+                task.description = patch.description
+
+            if patch.status is not None:
+                task.status = patch.status
+
+            if patch.priority is not None:
+                task.priority = patch.priority
+
+            self.tasks.replace(task)
+            updated.append(task)
+
+        self.notify('update', updated)
+
+        return [task.id for task in updated]
+
+    @deadlines.bounded
+    async def delete_tasks_by_ids(self, ids: list[str], owner: str) -> list[str]:
+        deleted = []
+        deleted_at = datetime.datetime.now(datetime.timezone.utc)
+
+        for table in (self.archive, self.tasks):
+            removed = []
+
+            for id in set(ids):
+                task = table.get(id)
+
+                if task is not None and task.owner == owner:
+                    removed.append(table.tombstone(id, deleted_at))
+
+            self.notify('delete', removed)
+            deleted.extend(task.id for task in removed)
+
+        return deleted
+
+    async def delete_task_by_id(self, id: str, owner: str) -> bool:
+        deleted = await self.delete_tasks_by_ids([id], owner)
+
+        return len(deleted) > 0
+
+    @deadlines.bounded
+    async def archive_done_tasks(
+            self, updated_before: datetime.datetime, limit: int,
+    ) -> int:
+        # отдельного индекса нет, задачи просматриваются целиком
+
+        candidates = (
+            task
+            for owner_tasks in self.tasks.owners.values()
+            for task in owner_tasks.tasks.values()
+            if task.status == models.TaskStatus.Done and task.updated_at < updated_before
+        )
+        moved = list(itertools.islice(candidates, limit))
+
+        for task in moved:
+            _, seq = self.tasks.remove(task.id)
+            self.archive.add(task, seq)
+
+        self.notify('archive', moved)
+
+        return len(moved)
+
+    @deadlines.bounded
+    async def purge_deleted_tasks(
+            self, deleted_before: datetime.datetime, limit: int,
+    ) -> int:
+        # задачи уже не видны, поэтому событий нет
+
+        count = self.archive.purge(deleted_before, limit)
+        count += self.tasks.purge(deleted_before, limit)
+
+        return count
+
+    async def export_tasks(self, owner: str, format: str) -> AsyncIterator[bytes]:
+        # формат повторяет COPY в database.Database
+
+        if format not in ('csv', 'ndjson'):
+            raise ValueError(f'unknown format {format}')
+
+        tasks = [
+            copy.copy(task)
+            for table in (self.tasks, self.archive)
+            for task in table.get_owner(owner).tasks.values()
+        ]
+
+        columns = ('id', 'title', 'description', 'status', 'priority', 'created_at', 'updated_at')
+
+        if format == 'csv':
+            buffer = io.StringIO()
+            csv.writer(buffer, lineterminator = '\n').writerow(columns)
+
+            yield buffer.getvalue().encode()
+
+        for offset in range(0, len(tasks), EXPORT_CHUNK_SIZE):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator = '\n')
+
+            for task in tasks[offset:offset + EXPORT_CHUNK_SIZE]:
+                if format == 'csv':
+                    writer.writerow((
+                        task.id,
+                        task.title,
+                        task.description,
+                        task.status.value,
+                        task.priority,
+                        task.created_at,
+                        task.updated_at,
+                    ))
+                else:
+                    obj = {
+                        'id': task.id,
+                        'title': task.title,
+                        'description': task.description,
+                        'status': task.status.value,
+                        'priority': task.priority,
+                        'created_at': task.created_at.isoformat(),
+                        'updated_at': task.updated_at.isoformat(),
+                    }
+                    buffer.write(json.dumps(obj, ensure_ascii = False, separators = (',', ':')))
+                    buffer.write('\n')
+
+            yield buffer.getvalue().encode()
+
+    async def import_tasks(self, tasks: AsyncIterator[models.Task]) -> int:
+        # как COPY: ошибка в любой записи отменяет весь импорт
+
+        batch = [task async for task in tasks]
+
+        self.insert_tasks(batch)
+
+        return len(batch)
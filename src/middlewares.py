@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
+import asyncio
 from typing import Callable, Awaitable
 import fastapi
 
 import utils
+import services
+import admission
+import deadlines
+import compressor
 
 
 JWT_COOKIE_NAME = 'jwt'
@@ -50,6 +55,17 @@ async def error_wrapper_middleware(
 ) -> fastapi.Response:
     try:
         return await next(request)
+    except deadlines.DeadlineExceededError as e:
+        return fastapi.responses.JSONResponse(
+            content = {'error': str(e)},
+            status_code = 504,
+        )
+    except services.OverloadedError as e:
+        return fastapi.responses.JSONResponse(
+            content = {'error': str(e)},
+            status_code = 503,
+            headers = {'Retry-After': '1'},
+        )
     except Exception as e:
         # да-да возвращаем всегда 400
 
@@ -57,3 +73,113 @@ async def error_wrapper_middleware(
             content = {'error': str(e)},
             status_code = 400,
         )
+
+
+async def admission_middleware(
+        request: fastapi.Request,
+        next: Callable[[fastapi.Request], Awaitable[fastapi.Response]],
+) -> fastapi.Response:
+    # выполняется после authenticate_middleware, так что пользователь уже известен,
+    # анонимные запросы (регистрация, логин) ограничиваются по адресу клиента
+
+    controller: admission.AdmissionController = request.app.state.admission
+
+    if controller.is_exempt(request.url.path):
+        return await next(request)
+
+    username = getattr(request.state, 'username', None)
+
+    if username is not None:
+        key = f'user:{username}'
+    elif request.client is not None:
+        key = f'ip:{request.client.host}'
+    else:
+        key = 'anonymous'
+
+    rejection = controller.acquire(key, request.url.path)
+
+    if rejection is not None:
+        return fastapi.responses.JSONResponse(
+            content = {'error': rejection.error},
+            status_code = rejection.status_code,
+            headers = {'Retry-After': str(rejection.retry_after)},
+        )
+
+    if not controller.holds_slot(request.url.path):
+        return await next(request)
+
+    try:
+        response = await next(request)
+    except BaseException:
+        controller.release()
+        raise
+
+    # next возвращает ответ до отправки тела, а выгрузка держит соединение
+    # с базой всё время COPY, поэтому слот освобождается только когда тело
+    # отправлено или поток оборван
+    body = utils.release_after(response.body_iterator, controller.release)
+
+    # первый шаг запускает генератор: запущенный генератор закрывается
+    # (и выполняет finally) даже если до тела дело так и не дошло
+    await body.__anext__()
+
+    response.body_iterator = body
+
+    return response
+
+
+async def deadline_middleware(
+        request: fastapi.Request,
+        next: Callable[[fastapi.Request], Awaitable[fastapi.Response]],
+) -> fastapi.Response:
+    # дедлайн попадает в database.Database через contextvar, по его истечении
+    # или при отключении клиента запрос в базе отменяется
+
+    policy: deadlines.DeadlinePolicy = request.app.state.deadline_policy
+
+    deadline = policy.create_deadline(
+        request.url.path, request.headers.get('x-request-timeout'),
+    )
+
+    if deadline is None:
+        return await next(request)
+
+    # тело GET никто не читает, поэтому receive можно слушать в фоне
+    # и узнать об отключении клиента пока запрос ещё выполняется
+
+    watcher = None
+
+    if request.method in ('GET', 'HEAD'):
+        watcher = asyncio.ensure_future(watch_disconnect(request, deadline))
+
+    token = deadlines.current.set(deadline)
+
+    try:
+        return await next(request)
+    finally:
+        deadlines.current.reset(token)
+
+        if watcher is not None:
+            watcher.cancel()
+
+
+async def watch_disconnect(request: fastapi.Request, deadline: deadlines.Deadline) -> None:
+    while True:
+        message = await request.receive()
+
+        if message['type'] == 'http.disconnect':
+            deadline.cancel()
+            return
+
+
+async def compression_middleware(
+        request: fastapi.Request,
+        next: Callable[[fastapi.Request], Awaitable[fastapi.Response]],
+) -> fastapi.Response:
+    # самый внешний, сжимает уже готовый ответ вместе с ошибками и cookie
+
+    response_compressor: compressor.ResponseCompressor = request.app.state.compressor
+
+    response = await next(request)
+
+    return await response_compressor.apply(request.headers.get('accept-encoding'), response)
@@ -28,3 +28,12 @@ class Task:
     priority: int
     created_at: datetime.datetime
     updated_at: datetime.datetime
+
+
+@dataclasses.dataclass
+class TaskPatch:
+    id: str
+    title: str | None
+    description: str | None
+    status: TaskStatus | None
+    priority: int | None
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import os
+
+import uvicorn
+
+
+HOST = os.getenv(
+    'HOST',
+    '0.0.0.0',
+)
+PORT = int(os.getenv(
+    'PORT',
+    '8000',
+))
+# сколько ждать завершения начатых запросов после SIGTERM,
+# потом оставшиеся (например SSE) обрываются
+SHUTDOWN_TIMEOUT = float(os.getenv(
+    'SHUTDOWN_TIMEOUT',
+    '30',
+))
+
+# по умолчанию процесс на ядро, процессы получают WORKERS через окружение
+# и по нему делят соединения с базой (см DATABASE_MAX_CONNECTIONS в app.py)
+os.environ.setdefault('WORKERS', str(os.cpu_count() or 1))
+
+import app
+
+
+def main() -> None:
+    if app.STORAGE == 'memory' and app.WORKERS > 1:
+        raise ValueError('memory storage can not be shared between workers')
+
+    # при нескольких процессах uvicorn сам пересылает им SIGTERM, каждый
+    # перестаёт принимать соединения, дожидается начатых запросов и
+    # выполняет завершение lifespan (воркеры, пачки вставок, пул)
+    uvicorn.run(
+        'app:app',
+        host = HOST,
+        port = PORT,
+        workers = app.WORKERS,
+        timeout_graceful_shutdown = SHUTDOWN_TIMEOUT,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
+import json
+import time
 import uuid
+import asyncio
 import datetime
+import collections
+import dataclasses
+from typing import AsyncIterator, Awaitable, Callable
 
 import utils
 import models
-import database
+import storage
+import batching
+import deadlines
+
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+MAX_IMPORT_RECORD_LENGTH = 1024 * 1024
 
 
 class InvalidCredentialsError(Exception):
@@ -16,9 +28,96 @@ class NotFoundError(Exception):
     pass
 
 
+class OverloadedError(Exception):
+    pass
+
+
 class UserService:
-    def __init__(self, db: database.Database) -> None:
+    def __init__(
+            self,
+            db: storage.Storage,
+            cache_size: int = 0,
+            cache_ttl: float = 0,
+            negative_ttl: float = 0,
+    ) -> None:
         self.db = db
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+
+        # username -> (когда протухает, пользователь), None значит что
+        # такого пользователя нет. Вытесняются давно не читанные
+        self.cache: collections.OrderedDict[str, tuple[float, models.User | None]] = (
+            collections.OrderedDict()
+        )
+        # растёт при каждой инвалидации, чтобы чтение начатое до неё
+        # не положило в кэш устаревший ответ
+        self.generation = 0
+        self.counters = collections.Counter()
+
+    def lookup(self, username: str) -> tuple[bool, models.User | None]:
+        entry = self.cache.get(username)
+
+        if entry is None:
+            return False, None
+
+        expires_at, user = entry
+
+        if expires_at <= time.monotonic():
+            del self.cache[username]
+            return False, None
+
+        self.cache.move_to_end(username)
+
+        return True, user
+
+    def remember(self, username: str, user: models.User | None) -> None:
+        ttl = self.cache_ttl if user is not None else self.negative_ttl
+
+        if self.cache_size <= 0 or ttl <= 0:
+            return
+
+        self.cache[username] = (time.monotonic() + ttl, user)
+        self.cache.move_to_end(username)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    def invalidate(self, username: str) -> None:
+        # любое изменение пользователя (регистрация, смена пароля) должно
+        # проходить через invalidate, иначе до TTL будет виден старый ответ
+
+        self.generation += 1
+        self.cache.pop(username, None)
+
+    async def find_user(self, username: str) -> models.User | None:
+        found, user = self.lookup(username)
+
+        if found:
+            self.counters['hits' if user is not None else 'negative_hits'] += 1
+            return user
+
+        self.counters['misses'] += 1
+
+        generation = self.generation
+        user = await self.db.find_user_by_username(username)
+
+        if generation == self.generation:
+            self.remember(username, user)
+
+        return user
+
+    def get_stats(self) -> dict:
+        hits = self.counters['hits'] + self.counters['negative_hits']
+        total = hits + self.counters['misses']
+
+        return {
+            'size': len(self.cache),
+            'hits': self.counters['hits'],
+            'negative_hits': self.counters['negative_hits'],
+            'misses': self.counters['misses'],
+            'hit_rate': hits / total if total > 0 else 0.0,
+        }
 
     async def register(self, username: str, password: str) -> models.User:
         if len(username) == 0:
@@ -27,10 +126,20 @@ class UserService:
         if len(password) == 0:
             raise ValueError('password is empty')
 
+        # известный пользователь отсекается без похода в базу
+        found, existing = self.lookup(username)
+
+        if found and existing is not None:
+            self.counters['hits'] += 1
+            raise storage.UserAlreadyExistsError(f'user {username} already exists')
+
         user = models.User(username, utils.hash_password(password))
 
         await self.db.create_user(user)
 
+        self.invalidate(username)
+        self.remember(username, user)
+
         return user
     
     async def login(self, username: str, password: str) -> models.User:
@@ -40,7 +149,7 @@ class UserService:
         if len(password) == 0:
             raise ValueError('password is empty')
 
-        user = await self.db.find_user_by_username(username)
+        user = await self.find_user(username)
 
         if user is None or utils.hash_password(password) != user.hashed_password:
             raise InvalidCredentialsError(f'invalid credentials')
@@ -49,10 +158,109 @@ class UserService:
 
 
 class TaskService:
-    def __init__(self, db: database.Database) -> None:
+    def __init__(
+            self,
+            db: storage.Storage,
+            max_batch_size: int,
+            max_copy_streams: int,
+            batcher: batching.InsertBatcher | None = None,
+    ) -> None:
         self.db = db
+        self.max_batch_size = max_batch_size
+        self.batcher = batcher
         self.cache = set()
 
+        # выгрузка и загрузка держат соединение пула всё время COPY,
+        # поэтому их одновременно может идти намного меньше размера пула
+        self.copy_streams = asyncio.Semaphore(max_copy_streams)
+
+        # чтения которые выполняются прямо сейчас, по пользователю и ключу запроса
+        self.flights: dict[str, dict[tuple, asyncio.Task]] = {}
+        # сколько запросов сейчас ждут каждый общий запрос
+        self.waiters: collections.Counter[asyncio.Task] = collections.Counter()
+        self.counters = collections.Counter()
+
+    async def coalesce(
+            self, username: str, key: tuple, factory: Callable[[], Awaitable],
+    ) -> object:
+        # одинаковые одновременные чтения ждут один общий запрос в базу,
+        # результат общий, поэтому вызывающие не должны его изменять
+
+        flights = self.flights.setdefault(username, {})
+        flight = flights.get(key)
+
+        if flight is None:
+            flight = asyncio.ensure_future(self.fly(factory))
+            flight.add_done_callback(lambda _: self.land(username, key, flight))
+            flights[key] = flight
+
+            self.counters['started'] += 1
+        else:
+            self.counters['joined'] += 1
+
+        self.waiters[flight] += 1
+
+        # shield чтобы отмена одного ожидающего не отменяла запрос остальным,
+        # при этом каждый ждёт не дольше своего дедлайна
+        try:
+            return await deadlines.run_bounded(asyncio.shield(flight))
+        finally:
+            self.waiters[flight] -= 1
+
+            if self.waiters[flight] == 0:
+                del self.waiters[flight]
+
+                # ушёл последний ожидающий, результат больше никому не нужен
+                if not flight.done():
+                    flight.cancel()
+                    self.forget(username, key, flight)
+
+                    self.counters['cancelled'] += 1
+
+    async def fly(self, factory: Callable[[], Awaitable]) -> object:
+        # общий запрос ограничен сроком первого запроса, но отключение его
+        # клиента не отменяет запрос, пока его ждут остальные, отменяет
+        # coalesce, когда уходит последний ожидающий
+
+        deadline = deadlines.current.get()
+
+        if deadline is not None:
+            deadlines.current.set(deadline.detach())
+
+        return await factory()
+
+    def land(self, username: str, key: tuple, flight: asyncio.Task) -> None:
+        if not flight.cancelled():
+            flight.exception()
+
+        self.forget(username, key, flight)
+
+    def forget(self, username: str, key: tuple, flight: asyncio.Task) -> None:
+        # отменённый запрос убирается сразу, чтобы к нему никто не присоединился
+
+        flights = self.flights.get(username)
+
+        if flights is None or flights.get(key) is not flight:
+            return
+
+        del flights[key]
+
+        if len(flights) == 0:
+            del self.flights[username]
+
+    def break_flights(self, username: str) -> None:
+        # после записи новые чтения не должны присоединяться к старым запросам
+
+        self.flights.pop(username, None)
+
+    def get_stats(self) -> dict:
+        return {
+            'in_flight': sum(len(flights) for flights in self.flights.values()),
+            'started': self.counters['started'],
+            'joined': self.counters['joined'],
+            'cancelled': self.counters['cancelled'],
+        }
+
     async def create_task(
             self,
             owner: str,
@@ -62,7 +270,7 @@ class TaskService:
             priority: int,
     ) -> models.Task:
         id = str(uuid.uuid4())
-        created = datetime.datetime.now()
+        created = datetime.datetime.now(datetime.timezone.utc)
         updated = created
 
         task = models.Task(
@@ -76,50 +284,96 @@ class TaskService:
             updated,
         )
 
-        await self.db.create_task(task)
+        if self.batcher is not None:
+            await self.batcher.insert(task)
+        else:
+            await self.db.create_task(task)
+
+        self.break_flights(owner)
 
         return task
     
+    def get_task_etag(self, task: models.Task) -> str:
+        return utils.create_etag(task.id, task.updated_at.isoformat())
+
+    async def get_tasks_version(self, username: str) -> int:
+        # версия меняется триггером на любую запись в задачи пользователя,
+        # поэтому для проверки не нужно вычитывать сами задачи
+
+        return await self.coalesce(
+            username,
+            ('version',),
+            lambda: self.db.find_tasks_version(username),
+        )
+
+    def get_tasks_etag(self, username: str, version: int, *params: object) -> str:
+        return utils.create_etag(username, version, *params)
+
     async def get_task(self, id: str, username: str) -> models.Task:
-        task = await self.db.find_task_by_id(id)
+        key = utils.normalize_id(id)
+
+        if key is None:
+            raise NotFoundError(f'task {id} not found')
+
+        task = await self.coalesce(
+            username,
+            ('get', key),
+            lambda: self.db.find_task_by_id(key, include_archived = True),
+        )
 
         if task is None or task.owner != username:
             raise NotFoundError(f'task {id} not found')
 
         return task
     
-    async def list_tasks(self, username: str, count: int = None) -> list[models.Task]:
-        # к сожалению фильтрация происходит в питоне, а не в базе
+    async def get_tasks(self, ids: list[str], username: str) -> dict[str, models.Task]:
+        self.check_batch_size(ids)
 
-        if count is not None and count < 0:
-            raise ValueError('count is negative')
+        # ответ строится по запрошенным идентификаторам, а не по каноничным
+        keys = {id: utils.normalize_id(id) for id in ids}
 
-        tasks = await self.db.find_tasks_by_owner(username)
-
-        tasks.sort(
-            key = lambda task: task.priority,
-            reverse = True,
+        tasks = await self.db.find_tasks_by_ids(
+            list(set(key for key in keys.values() if key is not None)), username,
         )
+        tasks = {task.id: task for task in tasks}
 
-        if count is not None:
-            tasks = tasks[:count]
+        return {id: tasks[key] for id, key in keys.items() if key in tasks}
 
-        return tasks
-    
-    async def search_tasks(self, username: str, text: str) -> list[models.Task]:
-        # к сожалению поиск тоже происходит в питоне, а не в базе
+    async def list_tasks(
+            self,
+            username: str,
+            count: int = None,
+            include_archived: bool = False,
+            version: int = None,
+    ) -> list[models.Task]:
+        # сортировка и ограничение делаются в хранилище, одинаковые
+        # запросы объединяются. Версия, под которой отдаётся ответ, входит
+        # в ключ: запрос начатый до её чтения мог вернуть задачи старее неё
 
-        if len(text) == 0:
-            raise ValueError('text is empty')
+        if count is not None and count < 0:
+            raise ValueError('count is negative')
 
-        tasks = await self.db.find_tasks_by_owner(username)
-        filtered = []
+        return await self.coalesce(
+            username,
+            ('top', count, include_archived, version),
+            lambda: self.db.find_top_tasks_by_owner(username, count, include_archived),
+        )
 
-        for task in tasks:
-            if text in task.title or text in task.description:
-                filtered.append(task)
+    async def search_tasks(
+            self,
+            username: str,
+            text: str,
+            include_archived: bool = False,
+            version: int = None,
+    ) -> list[models.Task]:
+        if len(text) == 0:
+            raise ValueError('text is empty')
 
-        return filtered
+        return await self.coalesce(
+            username,
+            ('search', text, include_archived, version),
+            lambda: self.db.search_tasks_by_owner(username, text, include_archived),
+        )
     
     async def update_task(
             self,
@@ -131,8 +385,14 @@ class TaskService:
             priority: int = None,
     ) -> None:
         # тут возможна гонка но что поделать...
+        # архивные задачи только читаются и удаляются, поэтому ищем без архива
+
+        key = utils.normalize_id(id)
+
+        if key is None:
+            raise NotFoundError(f'task {id} not found')
 
-        task = await self.db.find_task_by_id(id)
+        task = await self.db.find_task_by_id(key)
 
         if task is None or task.owner != username:
             raise NotFoundError(f'task {id} not found')
@@ -149,24 +409,208 @@ class TaskService:
         if priority is not None:
             task.priority = priority
 
-        task.updated_at = datetime.datetime.now()
+        task.updated_at = datetime.datetime.now(datetime.timezone.utc)
 
-        await self.db.update_task_by_id(id, task)
+        await self.db.update_task_by_id(key, task)
+        self.break_flights(username)
+
+    async def update_tasks(self, username: str, patches: list[models.TaskPatch]) -> set[str]:
+        self.check_batch_size(patches)
+
+        keys = {patch.id: utils.normalize_id(patch.id) for patch in patches}
+        valid = [patch for patch in patches if keys[patch.id] is not None]
+
+        if len(set(keys[patch.id] for patch in valid)) != len(valid):
+            raise ValueError('duplicate task id')
+
+        if len(valid) == 0:
+            return set()
+
+        updated = datetime.datetime.now(datetime.timezone.utc)
+        ids = await self.db.update_tasks_by_ids(
+            username,
+            [dataclasses.replace(patch, id = keys[patch.id]) for patch in valid],
+            updated,
+        )
+        self.break_flights(username)
+
+        ids = set(ids)
+
+        return set(patch.id for patch in valid if keys[patch.id] in ids)
 
     async def delete_task(self, id: str, username: str) -> None:
-        # тут возможна гонка но что поделать...
         # обратите внимание что здесь присутствует кэширование
 
+        id = utils.normalize_id(id)
+
+        if id is None:
+            return
+
         cache_key = (id, username)
 
         if cache_key in self.cache:
             return
-        
-        task = await self.db.find_task_by_id(id)
 
-        if task is None or task.owner != username:
+        # владелец проверяется в том же запросе, что и помечает задачу
+        deleted = await self.db.delete_task_by_id(id, username)
+        self.break_flights(username)
+
+        if not deleted:
             return
-        
-        await self.db.delete_task_by_id(id)
 
         self.cache.add(cache_key)
+
+    async def delete_tasks(self, ids: list[str], username: str) -> set[str]:
+        self.check_batch_size(ids)
+
+        # как и update_tasks возвращает запрошенные идентификаторы,
+        # задачи из кэша уже удалены и в базу не идут
+
+        keys = {id: utils.normalize_id(id) for id in ids}
+        cached = set(key for key in keys.values() if (key, username) in self.cache)
+        missing = [
+            key for key in set(keys.values())
+            if key is not None and key not in cached
+        ]
+
+        deleted = set()
+
+        if len(missing) > 0:
+            deleted = set(await self.db.delete_tasks_by_ids(missing, username))
+            self.break_flights(username)
+
+        for key in deleted:
+            self.cache.add((key, username))
+
+        return set(id for id, key in keys.items() if key in deleted or key in cached)
+
+    async def export_tasks(self, username: str, format: str) -> AsyncIterator[bytes]:
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f'unknown format {format}')
+
+        await self.acquire_copy_stream()
+
+        # слот освобождается когда тело отправлено или поток оборван
+        chunks = utils.release_after(
+            self.db.export_tasks(username, format), self.copy_streams.release,
+        )
+        await chunks.__anext__()
+
+        return chunks
+
+    async def import_tasks(
+            self, username: str, chunks: AsyncIterator[bytes], format: str,
+    ) -> int:
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f'unknown format {format}')
+
+        # строки разбираются по мере чтения тела и сразу уходят в COPY,
+        # при ошибке в любой строке COPY откатывается целиком
+
+        await self.acquire_copy_stream()
+
+        tasks = self.parse_tasks(username, chunks, format)
+
+        try:
+            return await self.db.import_tasks(tasks)
+        finally:
+            self.copy_streams.release()
+            self.break_flights(username)
+
+    async def acquire_copy_stream(self) -> None:
+        # не ждём свободного слота: пока ждали бы, клиент уже держит
+        # подключение, лучше сразу попросить повторить позже
+
+        if self.copy_streams.locked():
+            raise OverloadedError('too many exports and imports')
+
+        await self.copy_streams.acquire()
+
+    async def parse_tasks(
+            self, username: str, chunks: AsyncIterator[bytes], format: str,
+    ) -> AsyncIterator[models.Task]:
+        created = datetime.datetime.now(datetime.timezone.utc)
+        lines = utils.read_lines(chunks, MAX_IMPORT_RECORD_LENGTH)
+
+        if format == 'ndjson':
+            records = self.read_ndjson_records(lines)
+        else:
+            records = self.read_csv_records(lines)
+
+        number = 0
+
+        async for title, description, status, priority in records:
+            number += 1
+
+            if title is None or not isinstance(title, str):
+                raise TypeError(f'invalid title in record {number}')
+
+            if description is None or not isinstance(description, str):
+                raise TypeError(f'invalid description in record {number}')
+
+            try:
+                status = models.TaskStatus(status)
+            except Exception:
+                raise TypeError(f'invalid status in record {number}')
+
+            if priority is None or not isinstance(priority, int):
+                raise TypeError(f'invalid priority in record {number}')
+
+            yield models.Task(
+                str(uuid.uuid4()),
+                username,
+                title,
+                description,
+                status,
+                priority,
+                created,
+                created,
+            )
+
+    async def read_ndjson_records(self, lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+        async for line in lines:
+            if len(line.strip()) == 0:
+                continue
+
+            try:
+                obj = json.loads(line)
+            except Exception:
+                raise TypeError('invalid json')
+
+            if not isinstance(obj, dict):
+                raise TypeError('invalid json')
+
+            yield (
+                obj.get('title'),
+                obj.get('description'),
+                obj.get('status'),
+                obj.get('priority'),
+            )
+
+    async def read_csv_records(self, lines: AsyncIterator[str]) -> AsyncIterator[tuple]:
+        rows = utils.read_csv_rows(lines, MAX_IMPORT_RECORD_LENGTH)
+        header = None
+
+        async for row in rows:
+            if header is None:
+                header = row
+                continue
+
+            obj = dict(zip(header, row))
+            priority = obj.get('priority')
+
+            try:
+                priority = int(priority)
+            except Exception:
+                pass
+
+            yield (
+                obj.get('title'),
+                obj.get('description'),
+                obj.get('status'),
+                priority,
+            )
+
+    def check_batch_size(self, items: list) -> None:
+        if len(items) > self.max_batch_size:
+            raise ValueError(f'batch is larger than {self.max_batch_size}')
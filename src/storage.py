@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import datetime
+from typing import AsyncIterator, Protocol
+
+import models
+
+
+class UserAlreadyExistsError(Exception):
+    pass
+
+
+class Storage(Protocol):
+    # всё что сервисы и воркеры делают с данными, реализации:
+    # database.Database (PostgreSQL) и memory.MemoryStorage (в памяти процесса)
+
+    async def close(self) -> None: ...
+
+    async def ping(self) -> None: ...
+
+    async def create_user(self, user: models.User) -> None: ...
+
+    async def find_user_by_username(self, username: str) -> models.User | None: ...
+
+    async def create_task(self, task: models.Task) -> None: ...
+
+    async def create_tasks(self, tasks: list[models.Task]) -> None: ...
+
+    async def find_task_by_id(
+            self, id: str, include_archived: bool = False,
+    ) -> models.Task | None: ...
+
+    async def find_top_tasks_by_owner(
+            self, owner: str, count: int | None, include_archived: bool = False,
+    ) -> list[models.Task]: ...
+
+    async def search_tasks_by_owner(
+            self, owner: str, text: str, include_archived: bool = False,
+    ) -> list[models.Task]: ...
+
+    async def find_tasks_by_ids(self, ids: list[str], owner: str) -> list[models.Task]: ...
+
+    async def find_tasks_version(self, owner: str) -> int: ...
+
+    async def update_task_by_id(self, id: str, task: models.Task) -> None: ...
+
+    async def update_tasks_by_ids(
+            self,
+            owner: str,
+            patches: list[models.TaskPatch],
+            updated_at: datetime.datetime,
+    ) -> list[str]: ...
+
+    async def delete_tasks_by_ids(self, ids: list[str], owner: str) -> list[str]: ...
+
+    async def delete_task_by_id(self, id: str, owner: str) -> bool: ...
+
+    async def archive_done_tasks(
+            self, updated_before: datetime.datetime, limit: int,
+    ) -> int: ...
+
+    async def purge_deleted_tasks(
+            self, deleted_before: datetime.datetime, limit: int,
+    ) -> int: ...
+
+    def export_tasks(self, owner: str, format: str) -> AsyncIterator[bytes]: ...
+
+    async def import_tasks(self, tasks: AsyncIterator[models.Task]) -> int: ...
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import csv
+import uuid
 import hashlib
+from typing import AsyncIterator, Callable
 
 import jwt
 
@@ -23,3 +26,116 @@ def create_jwt_token(secret: str, obj: dict) -> str:
 
 def validate_jwt_token(secret: str, token: str) -> dict:
     return jwt.decode(token, secret, algorithms = [JWT_ALGORITHM])
+
+
+def match_route(routes: dict[str, object], path: str, default: object) -> object:
+    # точное совпадение или самый длинный префикс пути (/tasks/get
+    # подходит для /tasks/get/<id>)
+
+    if path in routes:
+        return routes[path]
+
+    value, length = default, -1
+
+    for prefix, prefix_value in routes.items():
+        if path.startswith(prefix + '/') and len(prefix) > length:
+            value, length = prefix_value, len(prefix)
+
+    return value
+
+
+def normalize_id(value: str) -> str | None:
+    # идентификаторы задач хранятся как uuid, всё остальное заведомо не найдётся
+
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+def create_etag(*parts: object) -> str:
+    data = '\0'.join(str(part) for part in parts)
+    digest = hashlib.sha256(data.encode()).hexdigest()
+
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    # If-None-Match использует слабое сравнение, поэтому W/ просто отбрасываем
+
+    if header is None:
+        return False
+
+    for value in header.split(','):
+        value = value.strip()
+
+        if value == '*':
+            return True
+
+        if value.startswith('W/'):
+            value = value[2:]
+
+        if value == etag:
+            return True
+
+    return False
+
+
+async def read_lines(chunks: AsyncIterator[bytes], max_length: int) -> AsyncIterator[str]:
+    buffer = b''
+
+    async for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+
+        if len(buffer) > max_length:
+            raise ValueError('line is too long')
+
+        for line in lines:
+            yield line.rstrip(b'\r').decode()
+
+    if len(buffer) > 0:
+        yield buffer.rstrip(b'\r').decode()
+
+
+async def read_csv_rows(lines: AsyncIterator[str], max_length: int) -> AsyncIterator[list[str]]:
+    # запись в кавычках может занимать несколько строк, она закончилась
+    # когда кавычек набралось чётное число ("" внутри поля чётность не меняет)
+
+    parts = []
+
+    async for line in lines:
+        parts.append(line)
+        record = '\n'.join(parts)
+
+        if record.count('"') % 2 != 0:
+            if len(record) > max_length:
+                raise ValueError('record is too long')
+
+            continue
+
+        parts = []
+
+        if len(record) == 0:
+            continue
+
+        yield next(csv.reader([record]))
+
+    if len(parts) > 0:
+        raise ValueError('unterminated quoted field')
+
+
+async def release_after(
+        body: AsyncIterator[bytes], release: Callable[[], None],
+) -> AsyncIterator[bytes]:
+    # первый шаг отдаёт пустой кусок: после него генератор запущен и его
+    # finally выполнится, даже если тело так и не начнут читать
+
+    try:
+        yield b''
+
+        async for chunk in body:
+            yield chunk
+    finally:
+        release()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import datetime
+
+import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    def __init__(self) -> None:
+        self.task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+
+        self.task.cancel()
+
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        self.task = None
+
+    async def run(self) -> None:
+        raise NotImplementedError
+
+
+class BatchWorker(Worker):
+    def __init__(self, batch_size: int, batch_delay: float, interval: float) -> None:
+        super().__init__()
+
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.interval = interval
+
+    async def run_batch(self) -> int:
+        raise NotImplementedError
+
+    async def run(self) -> None:
+        # обрабатываем небольшими пачками с паузой между ними, чтобы не мешать
+        # основной нагрузке, а когда обрабатывать нечего ждём подольше
+
+        while True:
+            try:
+                count = await self.run_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('%s failed to process batch', type(self).__name__)
+                count = 0
+
+            if count < self.batch_size:
+                await asyncio.sleep(self.interval)
+            else:
+                await asyncio.sleep(self.batch_delay)
+
+
+class Archiver(BatchWorker):
+    def __init__(
+            self,
+            db: storage.Storage,
+            age: datetime.timedelta,
+            batch_size: int,
+            batch_delay: float,
+            interval: float,
+    ) -> None:
+        super().__init__(batch_size, batch_delay, interval)
+
+        self.db = db
+        self.age = age
+
+    async def run_batch(self) -> int:
+        updated_before = datetime.datetime.now(datetime.timezone.utc) - self.age
+
+        return await self.db.archive_done_tasks(updated_before, self.batch_size)
+
+
+class Purger(BatchWorker):
+    # физически удаляет задачи, помеченные удалёнными дольше age назад,
+    # до этого строки остаются в таблицах и задачу можно восстановить
+
+    def __init__(
+            self,
+            db: storage.Storage,
+            age: datetime.timedelta,
+            batch_size: int,
+            batch_delay: float,
+            interval: float,
+    ) -> None:
+        super().__init__(batch_size, batch_delay, interval)
+
+        self.db = db
+        self.age = age
+
+    async def run_batch(self) -> int:
+        deleted_before = datetime.datetime.now(datetime.timezone.utc) - self.age
+
+        return await self.db.purge_deleted_tasks(deleted_before, self.batch_size)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import secrets
+import threading
+import concurrent.futures
+from typing import Iterator
 
 import requests
 
@@ -9,6 +13,10 @@ import requests
 IP = os.getenv('IP', '0.0.0.0')
 PORT = os.getenv('PORT', '8000')
 
+# сервер должен быть запущен с маленьким ARCHIVE_AFTER, например
+# ARCHIVE_AFTER=1 ARCHIVE_INTERVAL=1, иначе задачи не успеют попасть в архив
+ARCHIVE_WAIT = float(os.getenv('ARCHIVE_WAIT', '3'))
+
 
 class Client:
     def __init__(self) -> None:
@@ -106,13 +114,14 @@ class Client:
         if 'error' in obj:
             raise Exception(obj['error'])
 
-    def list_tasks(self, count: int = None) -> list[dict]:
+    def list_tasks(self, count: int = None, include_archived: bool = False) -> list[dict]:
         url = f'http://{IP}:{PORT}/tasks/list'
 
         response = self.session.get(
             url,
             params = {
                 'count': count,
+                'include_archived': 'true' if include_archived else 'false',
             },
         )
 
@@ -144,6 +153,81 @@ class Client:
 
         return tasks
 
+    def batch(self, operation: str, obj: dict) -> list[dict]:
+        url = f'http://{IP}:{PORT}/tasks/{operation}/batch'
+
+        response = self.session.post(url, json = obj)
+
+        obj = response.json()
+
+        if 'error' in obj:
+            raise Exception(obj['error'])
+
+        results = obj['results']
+
+        return results
+
+    def export_tasks(self, format: str) -> str:
+        url = f'http://{IP}:{PORT}/tasks/export'
+
+        response = self.session.get(url, params = {'format': format})
+        response.raise_for_status()
+
+        return response.text
+
+    def import_tasks(self, format: str, data: str) -> int:
+        url = f'http://{IP}:{PORT}/tasks/import'
+
+        response = self.session.post(url, params = {'format': format}, data = data.encode())
+
+        obj = response.json()
+
+        if 'error' in obj:
+            raise Exception(obj['error'])
+
+        count = obj['count']
+
+        return count
+
+    def get_conditional(self, path: str, params: dict = None, etag: str = None) -> tuple[int, str]:
+        url = f'http://{IP}:{PORT}{path}'
+
+        headers = {}
+
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        response = self.session.get(url, params = params, headers = headers)
+
+        return response.status_code, response.headers.get('ETag')
+
+    def listen_events(self, last_event_id: int = None) -> requests.Response:
+        url = f'http://{IP}:{PORT}/tasks/events'
+
+        headers = {}
+
+        if last_event_id is not None:
+            headers['Last-Event-ID'] = str(last_event_id)
+
+        return self.session.get(url, headers = headers, stream = True, timeout = 10)
+
+
+def read_event(lines: Iterator[str]) -> dict:
+    event = {}
+
+    for line in lines:
+        if len(line) == 0:
+            if len(event) > 0:
+                return event
+
+            continue
+
+        if line.startswith(':'):
+            continue
+
+        key, _, value = line.partition(': ')
+        event[key] = value
+
 
 def test_CRUD() -> None:
     print('=== testing CRUD ===')
@@ -281,11 +365,545 @@ def test_users() -> None:
         print(str(e))
 
 
+def test_etag() -> None:
+    print('=== testing etag ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    task_id = client.create_task('title1', 'description1', 'Waiting', 1)
+
+    # first request returns etag, repeated one is not modified
+
+    status1, etag1 = client.get_conditional(f'/tasks/get/{task_id}')
+    status2, etag2 = client.get_conditional(f'/tasks/get/{task_id}', etag = etag1)
+    print(f'- get task:')
+    print(status1, status2, etag1 == etag2)
+
+    status1, etag1 = client.get_conditional('/tasks/list')
+    status2, _ = client.get_conditional('/tasks/list', etag = etag1)
+    print(f'- list tasks:')
+    print(status1, status2)
+
+    # any write changes the etag of the list
+
+    client.create_task('title2', 'description2', 'Waiting', 2)
+
+    status3, etag3 = client.get_conditional('/tasks/list', etag = etag1)
+    print(f'- list tasks after create:')
+    print(status3, etag1 != etag3)
+
+
+def test_events() -> None:
+    print('=== testing events ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    stream = client.listen_events()
+    lines = stream.iter_lines(chunk_size = 1, decode_unicode = True)
+
+    task_id = client.create_task('title1', 'description1', 'Waiting', 1)
+    client.update_task(task_id, 'title2', 'description2', 'Done', 2)
+
+    created = read_event(lines)
+    updated = read_event(lines)
+    stream.close()
+
+    print(f'- received events:')
+    print(created)
+    print(updated)
+
+    # resume after the create event, only the update is replayed
+
+    client.delete_task(task_id)
+
+    stream = client.listen_events(int(created['id']))
+    lines = stream.iter_lines(chunk_size = 1, decode_unicode = True)
+
+    print(f'- resumed events:')
+    print(read_event(lines))
+    print(read_event(lines))
+    stream.close()
+
+
+def test_batch() -> None:
+    print('=== testing batch ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    task_id1 = client.create_task('title1', 'description1', 'Waiting', 1)
+    task_id2 = client.create_task('title2', 'description2', 'Waiting', 2)
+    missing = 'a7a4dbe3-9e04-4bc0-8c1a-0d0c0e0a0b0c'
+
+    # read several tasks at once, unknown and malformed ids are reported per id
+
+    results = client.batch('get', {'task_ids': [task_id1, task_id2, missing, 'not-a-uuid']})
+    print(f'- get batch:')
+    print(results)
+
+    # update only some fields of each task
+
+    results = client.batch('update', {
+        'tasks': [
+            {'task_id': task_id1.upper(), 'status': 'Done'},
+            {'task_id': task_id2, 'title': 'title3', 'priority': 3},
+            {'task_id': missing, 'title': 'title4'},
+        ],
+    })
+    print(f'- update batch:')
+    print(results)
+    print(client.get_task(task_id1))
+    print(client.get_task(task_id2))
+
+    # delete both, unknown and malformed ids are reported per id
+
+    results = client.batch('delete', {'task_ids': [task_id1, task_id2, missing, 'not-a-uuid']})
+    print(f'- delete batch:')
+    print(results)
+    print(client.list_tasks())
+
+    # deleting again is still reported as deleted
+
+    results = client.batch('delete', {'task_ids': [task_id1]})
+    print(f'- delete batch again:')
+    print(results)
+
+
+def test_export_import() -> None:
+    print('=== testing export and import ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    client.create_task('title1', 'multi\nline, "quoted" \\ description', 'Waiting', 1)
+    client.create_task('title2', 'description2', 'Done', 2)
+
+    # export in both formats
+
+    exported_csv = client.export_tasks('csv')
+    exported_ndjson = client.export_tasks('ndjson')
+    print(f'- exported csv:')
+    print(exported_csv)
+    print(f'- exported ndjson:')
+    print(exported_ndjson)
+
+    # import the exports into another user, tasks get new ids
+
+    other = Client()
+    other.register(secrets.token_hex(8), password)
+
+    print(f'- imported:')
+    print(other.import_tasks('csv', exported_csv))
+    print(other.import_tasks('ndjson', exported_ndjson))
+    print(other.list_tasks())
+
+    # invalid status rejects the whole import
+
+    try:
+        other.import_tasks('ndjson', '{"title": "x", "description": "y", "status": "Bad", "priority": 1}')
+    except Exception as e:
+        print(f'- failed to import:')
+        print(str(e))
+
+    # slow imports hold their COPY streams, extra exports are rejected
+
+    release = threading.Event()
+
+    def slow_body() -> Iterator[bytes]:
+        yield b'title,description,status,priority\n'
+        release.wait()
+        yield b'slow,slow,Waiting,1\n'
+
+    def slow_import() -> int:
+        importer = Client()
+        importer.register(secrets.token_hex(8), password)
+
+        response = importer.session.post(
+            f'http://{IP}:{PORT}/tasks/import',
+            params = {'format': 'csv'},
+            data = slow_body(),
+        )
+
+        return response.json()['count']
+
+    with concurrent.futures.ThreadPoolExecutor(10) as executor:
+        imports = []
+
+        for _ in range(10):
+            imports.append(executor.submit(slow_import))
+            time.sleep(0.3)
+
+            response = client.session.get(f'http://{IP}:{PORT}/tasks/export')
+
+            if response.status_code != 200:
+                break
+
+        print(f'- export while imports run:')
+        print(response.status_code, response.headers.get('Retry-After'))
+
+        release.set()
+
+        print(f'- slow imports:')
+        print([future.result() for future in imports])
+
+    print(f'- export after imports:')
+    print(client.session.get(f'http://{IP}:{PORT}/tasks/export').status_code)
+
+
+def test_soft_delete() -> None:
+    print('=== testing soft delete ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    task_id = client.create_task('deleted', 'description1', 'Waiting', 1)
+    client.create_task('kept', 'description2', 'Waiting', 2)
+
+    client.delete_task(task_id)
+
+    # deleted task stays in the table until purge, but no read returns it
+
+    print(f'- list, search, export:')
+    print([task['title'] for task in client.list_tasks()])
+    print([task['title'] for task in client.search_tasks('description')])
+    print(client.export_tasks('ndjson').count('deleted'))
+    print(f'- get batch:')
+    print(client.batch('get', {'task_ids': [task_id]}))
+
+    # and it can not be changed
+
+    try:
+        client.update_task(task_id, 'title2', 'description2', 'Done', 2)
+    except Exception as e:
+        print(f'- failed to update:')
+        print(str(e))
+
+    print(f'- update batch:')
+    print(client.batch('update', {'tasks': [{'task_id': task_id, 'title': 'title3'}]}))
+
+
+def test_archive() -> None:
+    print('=== testing archive ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    task_id = client.create_task('title1', 'description1', 'Done', 1)
+    client.create_task('title2', 'description2', 'InProgress', 2)
+
+    time.sleep(ARCHIVE_WAIT)
+
+    # done task is gone from the default listing but still readable
+
+    print(f'- list hot:')
+    print(client.list_tasks())
+    print(f'- list with archive:')
+    print(client.list_tasks(include_archived = True))
+    print(f'- get archived:')
+    print(client.get_task(task_id))
+
+
+def test_admission() -> None:
+    print('=== testing admission ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    # search is expensive, a burst of them is rate limited per user
+
+    url = f'http://{IP}:{PORT}/tasks/search'
+    statuses = []
+    retry_after = None
+
+    for _ in range(20):
+        response = client.session.get(url, params = {'text': 'x'})
+        statuses.append(response.status_code)
+
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+
+    print(f'- search burst:')
+    print(statuses.count(200), statuses.count(429), retry_after)
+
+    # other users are not affected
+
+    other = Client()
+    other.register(secrets.token_hex(8), password)
+
+    print(f'- other user:')
+    print(other.search_tasks('x'))
+
+    response = requests.get(f'http://{IP}:{PORT}/metrics')
+    print(f'- metrics:')
+    print(response.json())
+
+    # free routes do not take a slot, so they do not release one either
+
+    for _ in range(5):
+        requests.get(f'http://{IP}:{PORT}/')
+
+    response = requests.get(f'http://{IP}:{PORT}/metrics')
+    print(f'- in flight after free requests:')
+    print(response.json()['admission']['in_flight'])
+
+    # event streams only wait for events, so they do not hold a slot
+
+    def get_in_flight() -> int:
+        response = requests.get(f'http://{IP}:{PORT}/metrics')
+
+        return response.json()['admission']['in_flight']
+
+    events = other.listen_events()
+    time.sleep(0.5)
+    in_flight_open = get_in_flight()
+
+    events.close()
+    time.sleep(0.5)
+
+    print(f'- in flight with open event stream and after it:')
+    print(in_flight_open, get_in_flight())
+
+
+def test_single_flight() -> None:
+    print('=== testing single flight ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    for i in range(5):
+        client.create_task(f'title{i}', f'description{i}', 'Waiting', i)
+
+    def get_joined() -> int:
+        response = requests.get(f'http://{IP}:{PORT}/metrics')
+
+        return response.json()['single_flight']['joined']
+
+    # concurrent identical reads share one query
+
+    joined = get_joined()
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: len(client.list_tasks()), range(16)))
+
+    print(f'- concurrent listing:')
+    print(results, get_joined() - joined)
+
+    # a write is visible to the next read
+
+    client.create_task('title5', 'description5', 'Waiting', 5)
+
+    print(f'- listing after write:')
+    print(len(client.list_tasks()))
+
+
+def test_deadline() -> None:
+    print('=== testing deadline ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    client.create_task('title1', 'description1', 'Waiting', 1)
+
+    # a request with an already expired deadline is cut off before the query
+
+    response = client.session.get(
+        f'http://{IP}:{PORT}/tasks/list',
+        headers = {'X-Request-Timeout': '0.000001'},
+    )
+    print(f'- list with tiny timeout:')
+    print(response.status_code, response.json())
+
+    response = client.session.get(
+        f'http://{IP}:{PORT}/tasks/list',
+        headers = {'X-Request-Timeout': '5'},
+    )
+    print(f'- list with normal timeout:')
+    print(response.status_code, len(response.json()['tasks']))
+
+    # non-finite timeouts are rejected like non-positive ones
+
+    for timeout in ('nan', 'inf'):
+        response = client.session.get(
+            f'http://{IP}:{PORT}/tasks/list',
+            headers = {'X-Request-Timeout': timeout},
+        )
+        print(f'- list with {timeout} timeout:')
+        print(response.status_code, response.json())
+
+
+def test_concurrent_create() -> None:
+    print('=== testing concurrent create ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    # with CREATE_BATCH_SIZE > 0 these are written as a few multi-row inserts,
+    # each request still gets its own task id
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        task_ids = list(executor.map(
+            lambda i: client.create_task(f'title{i}', f'description{i}', 'Waiting', i),
+            range(16),
+        ))
+
+    print(f'- created:')
+    print(len(set(task_ids)), len(client.list_tasks()))
+
+    response = requests.get(f'http://{IP}:{PORT}/metrics')
+    print(f'- metrics:')
+    print(response.json().get('insert_batching'))
+
+
+def test_user_cache() -> None:
+    print('=== testing user cache ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    def get_stats() -> dict:
+        response = requests.get(f'http://{IP}:{PORT}/metrics')
+
+        return response.json()['user_cache']
+
+    # an unknown user is remembered as missing for a short time
+
+    stats = get_stats()
+
+    for _ in range(2):
+        try:
+            Client().login(username, password)
+        except Exception:
+            pass
+
+    print(f'- unknown user, negative hits:')
+    print(get_stats()['negative_hits'] - stats['negative_hits'])
+
+    # registration replaces the negative entry, so login works right away
+
+    client = Client()
+    client.register(username, password)
+
+    stats = get_stats()
+
+    for _ in range(3):
+        client.login(username, password)
+
+    print(f'- repeated login, hits and misses:')
+    print(get_stats()['hits'] - stats['hits'], get_stats()['misses'] - stats['misses'])
+
+
+def test_compression() -> None:
+    print('=== testing compression ===')
+
+    username = secrets.token_hex(8)
+    password = secrets.token_hex(8)
+
+    client = Client()
+    client.register(username, password)
+    client.login(username, password)
+
+    def get_encoding(path: str, accept_encoding: str) -> tuple[str, int]:
+        response = client.session.get(
+            f'http://{IP}:{PORT}{path}',
+            headers = {'Accept-Encoding': accept_encoding},
+        )
+
+        return response.headers.get('Content-Encoding'), len(response.content)
+
+    # small responses are sent as is
+
+    client.create_task('title0', 'description0', 'Waiting', 0)
+
+    print(f'- small list:')
+    print(get_encoding('/tasks/list', 'gzip'))
+
+    # large responses are compressed only if the client accepts it
+
+    for i in range(1, 20):
+        client.create_task(f'title{i}', 'long repeated description ' * 5, 'Waiting', i)
+
+    print(f'- large list:')
+    print(get_encoding('/tasks/list', 'gzip'))
+    print(get_encoding('/tasks/list', 'identity'))
+    print(len(client.list_tasks()))
+
+    # streamed export is compressed on the fly
+
+    print(f'- export:')
+    print(get_encoding('/tasks/export?format=csv', 'gzip'))
+
+
+def test_health() -> None:
+    print('=== testing health ===')
+
+    # probes are not authenticated and not rate limited
+
+    for path in ('/healthz', '/readyz'):
+        response = requests.get(f'http://{IP}:{PORT}{path}')
+        print(f'- {path}:')
+        print(response.status_code, response.json())
+
+
 def main() -> None:
     test_CRUD()
     test_listing()
     test_searching()
     test_users()
+    test_etag()
+    test_events()
+    test_batch()
+    test_export_import()
+    test_soft_delete()
+    test_archive()
+    test_admission()
+    test_single_flight()
+    test_deadline()
+    test_concurrent_create()
+    test_user_cache()
+    test_compression()
+    test_health()
 
 
 if __name__ == '__main__':